@@ -0,0 +1,118 @@
+import threading
+import time
+
+
+class RateLimiter:
+    # Token bucket: up to `rate` messages per `per` seconds, and at least min_interval seconds between two
+    def __init__(self, rate=20, per=60, min_interval=1):
+        self.rate = rate
+        self.per = per
+        self.min_interval = min_interval
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.last = None
+
+    def delay(self):
+        # Seconds to wait before the next message may be sent
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+        delay = 0 if self.tokens >= 1 else (1 - self.tokens) * self.per / self.rate
+        if self.last is not None:
+            delay = max(delay, self.last + self.min_interval - now)
+        return delay
+
+    def take(self):
+        self.tokens -= 1
+        self.last = time.monotonic()
+
+
+def retry_after(error):
+    # Seconds Telegram asked to wait for, None if the error isn't "Too Many Requests"
+    if getattr(error, "error_code", None) != 429:
+        return None
+    result = getattr(error, "result_json", None) or {}
+    return result.get("parameters", {}).get("retry_after", 1)
+
+
+class AlertDispatcher:
+    # Sends new device alerts of one chat from its own thread, so scanners only queue them.
+    # Alerts are collected for `window` seconds after the first one, or for as long as the rate limit
+    # holds the next message back if that's longer, then sent together as a digest of up to max_batch
+    # devices. send(mac_addrs) sends one digest and may block. It should raise only when the digest
+    # hasn't been sent: the devices are queued again then, and sent again after a delay.
+
+    def __init__(self, send, window=2, max_batch=20, rate=20, per=60, min_interval=1):
+        self.send = send
+        self.window = window
+        self.max_batch = max_batch
+        self.limiter = RateLimiter(rate, per, min_interval)
+
+        self.pending = []
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name="alerts", daemon=True)
+
+        self.sent = 0
+        self.digests = 0
+        self.failures = 0
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.pending:
+            print("%d new device alerts were not sent" % len(self.pending))
+
+    def notify(self, mac_addr):
+        with self._cond:
+            if mac_addr not in self.pending:
+                self.pending.append(mac_addr)
+                self._cond.notify()
+
+    def _loop(self):
+        failures = 0
+        # monotonic time before which a failed digest isn't sent again
+        retry_at = 0
+        while not self._stop.is_set():
+            with self._cond:
+                while not self.pending and not self._stop.is_set():
+                    self._cond.wait()
+
+            # The window, the rate limit and the retry delay run at the same time
+            deadline = max(time.monotonic() + self.window, retry_at)
+            while True:
+                wait = max(deadline - time.monotonic(), self.limiter.delay())
+                if wait <= 0:
+                    break
+                if self._stop.wait(wait):
+                    return
+
+            with self._cond:
+                batch = self.pending[:self.max_batch]
+                del self.pending[:len(batch)]
+
+            self.limiter.take()
+            try:
+                self.send(batch)
+            except Exception as e:
+                with self._cond:
+                    self.pending[:0] = batch
+                self.failures += 1
+                failures += 1
+                wait = retry_after(e)
+                if wait is None:
+                    wait = min(300, 2 ** failures)
+                    print("Failed to send new device alerts: %r" % e)
+                retry_at = time.monotonic() + wait
+                continue
+
+            failures = 0
+            self.sent += len(batch)
+            self.digests += 1
@@ -1,45 +1,370 @@
+import threading
 import time
-from datetime import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_address, ip_network
+from queue import Queue
 
-from scanner import AbstractScanner
+from scanner import AbstractScanner, normalize_mac
 
 from scapy.layers.l2 import Ether, ARP
+from scapy.layers.inet import IP
 from scapy.config import conf
-from scapy.sendrecv import srp
+from scapy.sendrecv import srp, sniff, AsyncSniffer
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Pipe
 
 
-def arp_scan(queue, subnet, interface):
+ShardStat = namedtuple("ShardStat", ["shard", "duration", "probes", "found"])
+
+
+def arp_scan(subnet, interface, timeout=2, retry=1, inter=0):
+    # srp returns as soon as every probe is answered, otherwise timeout seconds after the last one.
+    # Each retry round resends the unanswered probes and waits the timeout again, and most addresses
+    # of a sweep never answer, so a sweep takes about (retry + 1) * timeout plus the sending time.
+    # Hosts on the link answer within milliseconds, a couple of seconds is plenty.
+    ans, uan = srp(Ether(dst="ff:ff:ff:ff:ff:ff") / ARP(pdst=subnet), timeout=timeout, iface=interface,
+                   retry=retry, inter=inter)
+
+    return [(rcv.sprintf("%Ether.src%"), rcv.sprintf("%ARP.psrc%")) for snd, rcv in ans]
+
+
+def arp_probe(targets, interface, timeout=2, retry=1, inter=0):
+    # Unicast probes for (mac_addr, ip_addr) pairs
+    packets = [Ether(dst=mac_addr) / ARP(pdst=ip_addr) for mac_addr, ip_addr in targets]
+    ans, uan = srp(packets, timeout=timeout, iface=interface, retry=retry, inter=inter)
+
+    return [(rcv.sprintf("%Ether.src%"), rcv.sprintf("%ARP.psrc%")) for snd, rcv in ans]
+
+
+def worker_loop(conn):
     conf.verb = 0
-    ans, uan = srp(Ether(dst="ff:ff:ff:ff:ff:ff") / ARP(pdst=subnet), timeout=10, iface=interface, retry=3)
 
-    for snd, rcv in ans:
-        mac_addr = rcv.sprintf("%Ether.src%")
-        ip_addr = rcv.sprintf("%ARP.psrc%")
+    while True:
+        try:
+            command = conn.recv()
+        except EOFError:
+            break
+        if command is None:
+            break
+
+        fn, args = command
+        try:
+            conn.send(("ok", fn(*args)))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+class ARPWorker:
+    # Long-lived process that runs scapy functions sent over a pipe. Each call returns
+    # the function result as one message. The process is restarted if it dies.
+
+    def __init__(self, name="arp-worker"):
+        self.name = name
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        if self.process is not None:
+            self.restarts += 1
+            print("WARNING: %s has died, restarting it" % self.name)
+            self._terminate()
+
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=worker_loop, args=(child_conn,), name=self.name, daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def _terminate(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+    def _call(self, fn, args):
+        if self.process is None or not self.process.is_alive():
+            self._spawn()
+
+        try:
+            self.conn.send((fn, args))
+            # Polling with a short timeout lets us notice the worker's death
+            while not self.conn.poll(1):
+                if not self.process.is_alive():
+                    raise EOFError
+            status, result = self.conn.recv()
+        except (EOFError, OSError):
+            self._spawn()
+            raise WorkerCrashed("%s has crashed while running %s" % (self.name, fn.__name__))
+
+        if status == "error":
+            raise RuntimeError("%s failed: %s" % (fn.__name__, result))
+        return result
+
+    def call(self, fn, *args):
+        with self._lock:
+            try:
+                return self._call(fn, args)
+            except WorkerCrashed:
+                # One more attempt with the restarted worker
+                return self._call(fn, args)
+
+    def stop(self):
+        with self._lock:
+            if self.process is None:
+                return
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(5)
+            self._terminate()
+            self.process = None
+
+
+class PassiveMonitor:
+    # Sniffs ARP and IPv4 traffic from the subnet and keeps the time each MAC address was last seen.
+    # Hosts are reported with their IPv4 address, so other traffic (IPv6 neighbor discovery, LLDP, ...)
+    # isn't captured: a host that sends none of the former is found by the active sweeps only.
+    # replay() feeds packets from pcap files instead of a live interface.
+
+    def __init__(self, interface, subnet, ttl):
+        self.interface = interface
+        self.network = ip_network(subnet, strict=False)
+        self.ttl = ttl
+        self.bpf_filter = "arp or (ip src net %s)" % self.network
+
+        self.last_seen = {}
+        self._lock = threading.Lock()
+        self.sniffer = None
+
+    def handle_packet(self, pkt):
+        if ARP in pkt:
+            mac_addr, ip_addr = pkt[ARP].hwsrc, pkt[ARP].psrc
+        elif IP in pkt and Ether in pkt:
+            mac_addr, ip_addr = pkt[Ether].src, pkt[IP].src
+        else:
+            return
+
+        # Skips ARP probes with no sender address and routed traffic from other networks
+        if ip_address(ip_addr) not in self.network or ip_addr == "0.0.0.0":
+            return
+
+        self.update([(mac_addr, ip_addr)], float(pkt.time))
+
+    def update(self, hosts, timestamp=None):
+        timestamp = timestamp or time.time()
+        with self._lock:
+            for mac_addr, ip_addr in hosts:
+                mac_addr = normalize_mac(mac_addr)
+                prev = self.last_seen.get(mac_addr)
+                if prev is None or prev[1] <= timestamp:
+                    self.last_seen[mac_addr] = (ip_addr, timestamp)
+
+    def hosts(self, now=None):
+        # Returns hosts seen within ttl and forgets the older ones
+        deadline = (now or time.time()) - self.ttl
+        with self._lock:
+            for mac_addr in [m for m, (_, t) in self.last_seen.items() if t < deadline]:
+                del self.last_seen[mac_addr]
+            return [(mac_addr, ip_addr) for mac_addr, (ip_addr, _) in self.last_seen.items()]
 
-        queue.put((mac_addr, ip_addr))
+    def replay(self, *pcap_files):
+        sniff(offline=list(pcap_files), prn=self.handle_packet, store=False)
+
+    def start(self):
+        self.sniffer = AsyncSniffer(iface=self.interface, filter=self.bpf_filter,
+                                    prn=self.handle_packet, store=False)
+        self.sniffer.start()
+
+    def stop(self):
+        if self.sniffer is not None and self.sniffer.running:
+            self.sniffer.stop()
+        self.sniffer = None
+
+
+class ProbeState:
+    __slots__ = ["ip_addr", "present", "streak", "last_seen", "next_probe"]
+
+    def __init__(self, ip_addr, cycle):
+        self.ip_addr = ip_addr
+        self.present = False
+        self.streak = 0
+        self.last_seen = cycle
+        self.next_probe = cycle
+
+
+class AdaptiveProber:
+    # Decides which known hosts have to be probed in a cycle. A host that keeps answering is probed
+    # less often: after n consecutive answers the next probe is made in 2^n cycles, but at most in
+    # max_backoff cycles. A host that stops answering is probed every cycle until it hasn't been
+    # seen for forget_after cycles, so its return is noticed as fast as its departure.
+
+    def __init__(self, max_backoff=4, forget_after=60):
+        self.max_backoff = max_backoff
+        self.forget_after = forget_after
+        self.hosts = {}
+
+    def due(self, cycle):
+        return [(mac_addr, st.ip_addr) for mac_addr, st in self.hosts.items() if st.next_probe <= cycle]
+
+    def update(self, cycle, probed, found):
+        # probed is the list of MAC addresses which were expected to answer, found are (mac, ip) pairs
+        found = {normalize_mac(mac_addr): ip_addr for mac_addr, ip_addr in found}
+
+        for mac_addr, ip_addr in found.items():
+            st = self.hosts.get(mac_addr)
+            if st is None:
+                st = self.hosts[mac_addr] = ProbeState(ip_addr, cycle)
+            st.streak = st.streak + 1 if st.present else 0
+            st.present = True
+            st.ip_addr = ip_addr
+            st.last_seen = cycle
+            st.next_probe = cycle + min(2 ** st.streak, self.max_backoff)
+
+        for mac_addr in probed:
+            st = self.hosts.get(mac_addr)
+            if st is None or mac_addr in found:
+                continue
+            if cycle - st.last_seen >= self.forget_after:
+                del self.hosts[mac_addr]
+                continue
+            st.present = False
+            st.streak = 0
+            st.next_probe = cycle + 1
+
+    def present(self):
+        return [(mac_addr, st.ip_addr) for mac_addr, st in self.hosts.items() if st.present]
 
 
 class ARPScanner(AbstractScanner):
-    def __init__(self, interval, interface, subnet):
+    # In passive mode hosts are detected by sniffing the traffic, and an active sweep is made only
+    # every active_every cycles (never if not set). A sniffed host is reported as present for
+    # presence_ttl seconds, two intervals by default.
+    #
+    # If shard_prefix is set, the subnet is split into subnets of that size, which are swept in
+    # parallel by `workers` processes. `rate` limits the total number of probes sent per second.
+    #
+    # In adaptive mode the whole subnet is swept only every full_sweep_every cycles. In between,
+    # known hosts are checked with unicast probes according to AdaptiveProber.
+
+    def __init__(self, interval, interface, subnet, passive=False, active_every=None, presence_ttl=None,
+                 shard_prefix=None, workers=1, rate=None, timeout=2, retry=1,
+                 adaptive=False, full_sweep_every=10, max_backoff=4):
         super().__init__(interval)
+        if passive and adaptive:
+            raise ValueError("Passive and adaptive modes can't be used together")
+
         self.interface = interface
         self.subnet = subnet
 
+        network = ip_network(subnet, strict=False)
+        if shard_prefix is not None and shard_prefix > network.prefixlen:
+            self.shards = [str(n) for n in network.subnets(new_prefix=shard_prefix)]
+        else:
+            self.shards = [subnet]
+
+        workers = max(1, min(workers, len(self.shards)))
+        self.workers = [ARPWorker("arp-worker-%d" % i) for i in range(workers)]
+        self._idle_workers = Queue()
+        for w in self.workers:
+            self._idle_workers.put(w)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="arp-sweep")
+
+        self.probe_timeout = timeout
+        self.retry = retry
+        self.probe_inter = workers / rate if rate else 0
+        self.shard_stats = []
+
+        self.full_sweep_every = full_sweep_every
+        self.prober = AdaptiveProber(max_backoff, forget_after=full_sweep_every) if adaptive else None
+        self.probes_sent = 0
+
+        self.active_every = active_every
+        self.cycles = 0
+        self.monitor = None
+        if passive:
+            self.monitor = PassiveMonitor(interface, subnet, presence_ttl or 2 * interval)
+
+    def _sweep_shard(self, shard):
+        worker = self._idle_workers.get()
+        try:
+            start = time.monotonic()
+            hosts = worker.call(arp_scan, shard, self.interface, self.probe_timeout, self.retry, self.probe_inter)
+            stat = ShardStat(shard, time.monotonic() - start, ip_network(shard).num_addresses, len(hosts))
+            return stat, hosts
+        finally:
+            self._idle_workers.put(worker)
+
+    def sweep(self):
+        start = time.monotonic()
+        results = list(self.pool.map(self._sweep_shard, self.shards))
+        duration = time.monotonic() - start
+
+        self.shard_stats = [stat for stat, _ in results]
+        if len(self.shards) > 1:
+            slowest = max(self.shard_stats, key=lambda x: x.duration)
+            print("ARP sweep of %d shards took %.1f s, the slowest was %s (%.1f s)" %
+                  (len(self.shards), duration, slowest.shard, slowest.duration))
+
+        return [host for _, hosts in results for host in hosts]
+
+    def probe(self, targets):
+        # Unicast probes are few, they are split between the workers without sharding the subnet
+        chunks = [targets[i::len(self.workers)] for i in range(len(self.workers))]
+
+        def probe_chunk(chunk):
+            worker = self._idle_workers.get()
+            try:
+                return worker.call(arp_probe, chunk, self.interface, min(self.probe_timeout, 2), 1,
+                                   self.probe_inter)
+            finally:
+                self._idle_workers.put(worker)
+
+        results = self.pool.map(probe_chunk, [c for c in chunks if c])
+        return [host for hosts in results for host in hosts]
+
+    def adaptive_scan(self):
+        cycle = self.cycles
+        self.cycles += 1
+
+        if cycle % self.full_sweep_every == 0:
+            probed = list(self.prober.hosts)
+            found = self.sweep()
+            self.probes_sent = sum(ip_network(shard).num_addresses for shard in self.shards)
+        else:
+            targets = self.prober.due(cycle)
+            probed = [mac_addr for mac_addr, _ in targets]
+            found = self.probe(targets) if targets else []
+            self.probes_sent = len(targets)
+
+        self.prober.update(cycle, probed, found)
+        return self.prober.present()
+
     def scan(self):
-        queue = Queue()
-        p = Process(target=arp_scan, args=(queue, self.subnet, self.interface))
-        start_time = time.time()
-        p.start()
-        p.join()
-        end_time = time.time()
+        if self.prober is not None:
+            return self.adaptive_scan()
+        if self.monitor is None:
+            return self.sweep()
+
+        if self.monitor.sniffer is None:
+            self.monitor.start()
 
-        if end_time - start_time > self.scan_interval:
-            print("WARNING: Scan was longer than interval. Sequent scans can overlap and cause CPU overloading.")
+        if self.active_every and self.cycles % self.active_every == 0:
+            self.monitor.update(self.sweep())
+        self.cycles += 1
 
-        self.last_scan = timestamp = datetime.now()
+        return self.monitor.hosts()
 
-        while not queue.empty():
-            mac_addr, ip_addr = queue.get()
-            self.add_scan_result(mac_addr, ip_addr, timestamp)
+    def stop(self):
+        super().stop()
+        if self.monitor is not None:
+            self.monitor.stop()
+        self.pool.shutdown()
+        for w in self.workers:
+            w.stop()
@@ -0,0 +1,149 @@
+import asyncio
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import telebot.types
+from aiohttp import web
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from bot import TelegramBot
+
+
+class AsyncBotClient:
+    # Blocking facade over AsyncTeleBot for ChatFSM and the other callers running in threads.
+    # The requests run on the event loop, so requests from different threads are sent concurrently
+    # over the pooled keep-alive connections of the aiohttp session.
+
+    def __init__(self, bot, loop, timeout=None):
+        self._bot = bot
+        self._loop = loop
+        self.timeout = timeout
+
+    def __getattr__(self, name):
+        method = getattr(self._bot, name)
+
+        def call(*args, **kwargs):
+            return asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self._loop).result(self.timeout)
+
+        return call
+
+
+class AsyncTelegramBot(TelegramBot):
+    # TelegramBot running the Bot API client on an asyncio event loop in its own thread.
+    # Updates are received by long polling or, when webhook_url is set, by a local HTTP server that
+    # Telegram (or a reverse proxy in front of it) posts them to. Handlers still run on the
+    # ChatDispatcher threads, so BotState and InlineKeyboard handlers stay the same.
+    #
+    # api_url replaces https://api.telegram.org, e.g. for a local Bot API server.
+
+    def __init__(self, token, initial_state, api_url=None, request_timeout=None, polling_timeout=20,
+                 webhook_url=None, webhook_listen="0.0.0.0", webhook_port=8443, webhook_secret=None, **kwargs):
+        self.api_url = api_url
+        self.request_timeout = request_timeout
+        self.polling_timeout = polling_timeout
+        self.webhook_url = webhook_url
+        self.webhook_listen = webhook_listen
+        self.webhook_port = webhook_port
+        self.webhook_secret = webhook_secret
+
+        # The rest are TelegramBot's arguments
+        super().__init__(token, initial_state, **kwargs)
+
+    def create_client(self, token):
+        if self.api_url is not None:
+            asyncio_helper.API_URL = self.api_url.rstrip("/") + "/bot{0}/{1}"
+
+        self.async_bot = AsyncTeleBot(token)
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="bot-loop", daemon=True)
+        # Hands updates to the dispatcher one at a time, so they keep their order and the dispatcher's
+        # backpressure holds up the polling (or the webhook response) instead of the event loop
+        self._feeder = ThreadPoolExecutor(1, thread_name_prefix="bot-feeder")
+        self._receiver = None
+        self._runner = None
+        self.offset = None
+
+        return AsyncBotClient(self.async_bot, self.loop, self.request_timeout)
+
+    def start(self):
+        self.loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_receiving(), self.loop).result()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._stop_receiving(), self.loop).result()
+        self._feeder.shutdown(wait=True)
+        # Handlers still running may need the event loop for their requests
+        self.dispatcher.stop()
+        asyncio.run_coroutine_threadsafe(self._close_session(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    async def _start_receiving(self):
+        if self.webhook_url is None:
+            await self.async_bot.delete_webhook()
+            self._receiver = asyncio.ensure_future(self._poll())
+            return
+
+        app = web.Application()
+        app.router.add_post(urlsplit(self.webhook_url).path or "/", self._on_webhook)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.webhook_listen, self.webhook_port).start()
+        await self.async_bot.set_webhook(self.webhook_url, secret_token=self.webhook_secret)
+
+    async def _stop_receiving(self):
+        if self._receiver is not None:
+            self._receiver.cancel()
+            try:
+                await self._receiver
+            except asyncio.CancelledError:
+                pass
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _close_session(self):
+        # telebot keeps one aiohttp session per thread, this is the event loop's one
+        session = asyncio_helper.session_manager.session
+        if session is not None:
+            await session.close()
+
+    async def _poll(self):
+        failures = 0
+        while True:
+            try:
+                updates = await self.async_bot.get_updates(offset=self.offset, timeout=self.polling_timeout,
+                                                           request_timeout=self.polling_timeout + 10)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                print("Polling failed: %r" % e)
+                await asyncio.sleep(min(60, 2 ** failures))
+                continue
+
+            failures = 0
+            if updates:
+                self.offset = updates[-1].update_id + 1
+                await self.loop.run_in_executor(self._feeder, self._process_updates, updates)
+
+    async def _on_webhook(self, request):
+        if self.webhook_secret is not None:
+            secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(secret, self.webhook_secret):
+                return web.Response(status=403)
+
+        update = telebot.types.Update.de_json(await request.text())
+        # Telegram sends the next update only after this one is answered
+        await self.loop.run_in_executor(self._feeder, self._process_updates, [update])
+        return web.Response()
+
+    def _process_updates(self, updates):
+        for update in updates:
+            try:
+                self.process_update(update)
+            except Exception as e:
+                print("Failed to process update %s: %r" % (update.update_id, e))
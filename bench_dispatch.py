@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+# Measures ChatFSM message dispatch without the network, against the way states were dispatched
+# before the dispatch tables were compiled (buttons rebuilt per state, patterns searched uncompiled,
+# keyboards built per reply).
+# Usage: bench_dispatch.py [messages]
+
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+from bot import BotState, ChatFSM, build_keyboard
+
+
+class NullClient:
+    # Stands in for TeleBot, accepts the requests and drops them
+    def send_message(self, chat_id, text, **kwargs):
+        return SimpleNamespace(message_id=1)
+
+
+class MenuState(BotState):
+    commands = {"/start": "start"}
+    buttons = [
+        {"Who is here": "who", "Last hour": "last_hour", "History": "history"},
+        {"Add person": "add", "Add device": "add"},
+    ]
+    patterns = {
+        r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$": "mac_addr",
+        r"^\d+\.\d+\.\d+\.\d+$": "ip_addr",
+    }
+
+    def start(self, args):
+        self.chat.reply("Started", new_state=MenuState)
+
+    def who(self):
+        self.chat.reply("Nobody")
+
+    def last_hour(self):
+        self.chat.reply("Nobody")
+
+    def history(self):
+        self.chat.reply("Nothing")
+
+    def add(self):
+        self.chat.reply("Name?", new_state=InputState)
+
+    def mac_addr(self, text):
+        self.chat.reply("MAC address")
+
+    def ip_addr(self, text):
+        self.chat.reply("IP address")
+
+    def default(self, text):
+        self.chat.reply("Use the keyboard")
+
+
+class InputState(BotState):
+    buttons = [{"Cancel": "cancel"}]
+
+    def cancel(self):
+        self.chat.reply("Canceled", new_state=MenuState)
+
+    def default(self, text):
+        self.chat.reply("Saved", new_state=MenuState)
+
+
+def legacy_message(chat, msg):
+    state = chat.state
+    buttons_dict = {}
+    for row in state.buttons:
+        for label in row:
+            buttons_dict[label] = row[label]
+
+    text = msg.text
+    cmd_args = text.split(" ")
+    cmd_name = cmd_args.pop(0)
+
+    if cmd_name in state.commands:
+        getattr(state, state.commands[cmd_name])(cmd_args)
+    elif text in buttons_dict:
+        getattr(state, buttons_dict[text])()
+    else:
+        matched = False
+        for pattern in state.patterns:
+            if re.search(pattern, text):
+                matched = True
+                getattr(state, state.patterns[pattern])(text)
+        if not matched:
+            state.default(text)
+
+
+class LegacyChatFSM(ChatFSM):
+    def message(self, msg):
+        legacy_message(self, msg)
+
+    def reply(self, text, new_state=None, **kwargs):
+        reply_markup = build_keyboard(new_state.buttons) if new_state is not None else None
+        self.bot.send_message(self.chat_id, text, reply_markup=reply_markup)
+        if new_state is not None:
+            self.state = new_state(self)
+
+
+def make_messages(count):
+    texts = ["/start", "Who is here", "Last hour", "History", "00:1a:2b:3c:4d:5e", "10.0.0.1",
+             "hello", "Add device", "phone", "Add person", "Cancel"]
+    return [SimpleNamespace(content_type="text", text=texts[i % len(texts)]) for i in range(count)]
+
+
+def measure(name, chat, messages):
+    chat.set_state(MenuState)
+    start = time.perf_counter()
+    for msg in messages:
+        chat.message(msg)
+    elapsed = time.perf_counter() - start
+    print("%-10s %8d messages in %7.3f s  %10.0f messages/s" % (name, len(messages), elapsed, len(messages) / elapsed))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    messages = make_messages(count)
+
+    measure("legacy", LegacyChatFSM(NullClient(), 1), messages)
+    measure("compiled", ChatFSM(NullClient(), 1), messages)
+
+
+if __name__ == "__main__":
+    main()
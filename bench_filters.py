@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+# Compares the compiled HostFilter with a linear scan over the rules.
+# Usage: bench_filters.py [rules] [hosts]
+
+import random
+import sys
+import time
+from ipaddress import ip_address, ip_network
+
+from filters import HostFilter
+
+
+def make_rules(count, rnd):
+    cidrs = set()
+    while len(cidrs) < count:
+        prefix = rnd.choice([16, 20, 24, 28, 32])
+        addr = rnd.getrandbits(32)
+        cidrs.add(str(ip_network((addr, prefix), strict=False)))
+    cidrs = sorted(cidrs)
+    ouis = ["%02x:%02x:%02x" % (rnd.getrandbits(8), rnd.getrandbits(8), rnd.getrandbits(8)) for _ in range(count)]
+
+    # A fifth of the rules exclude addresses
+    split = count // 5
+    return {
+        "include": cidrs[split:],
+        "exclude": cidrs[:split],
+        "exclude_macs": ouis[:split],
+    }
+
+
+def make_hosts(count, rnd):
+    return [(":".join("%02x" % rnd.getrandbits(8) for _ in range(6)), str(ip_address(rnd.getrandbits(32))))
+            for _ in range(count)]
+
+
+def linear_match(rules, host):
+    mac_addr, ip_addr = host
+    addr = ip_address(ip_addr)
+    if not any(addr in n for n in rules["include"]):
+        return False
+    if any(addr in n for n in rules["exclude"]):
+        return False
+    if any(mac_addr.startswith(p) for p in rules["exclude_macs"]):
+        return False
+    return True
+
+
+def measure(name, fn, hosts):
+    start = time.perf_counter()
+    result = fn(hosts)
+    elapsed = time.perf_counter() - start
+    print("%-10s %8d hosts in %7.3f s  %10.0f hosts/s" % (name, len(hosts), elapsed, len(hosts) / elapsed))
+    return result
+
+
+def main():
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    host_count = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+
+    rnd = random.Random(1)
+    settings = make_rules(rule_count, rnd)
+    hosts = make_hosts(host_count, rnd)
+
+    start = time.perf_counter()
+    host_filter = HostFilter.from_settings(settings)
+    print("compiled %d rules in %.3f s" % (sum(map(len, settings.values())), time.perf_counter() - start))
+
+    compiled = measure("compiled", host_filter.apply, hosts)
+
+    # The linear scan is too slow for every host, a sample is enough to compare the rates
+    rules = {
+        "include": [ip_network(c) for c in settings["include"]],
+        "exclude": [ip_network(c) for c in settings["exclude"]],
+        "exclude_macs": settings["exclude_macs"],
+    }
+    sample = hosts[:max(1, host_count // 100)]
+    linear = measure("linear", lambda hs: [h for h in hs if linear_match(rules, h)], sample)
+
+    sampled = set(sample)
+    assert linear == [h for h in compiled if h in sampled]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+# Compares per-row ingestion of scan results into presence intervals with the scanner's batched one.
+# Both extend the intervals of hosts still present, start new ones and update DeviceLastSeen; the
+# per-row path does it with a statement and a transaction per host. A tenth of the hosts is missing
+# in turn from each cycle, so intervals are closed and started again too.
+# Usage: bench_ingest.py [hosts] [cycles]
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from models import db, Person, Device, DeviceLastSeen
+from partitions import partitions
+from scanner import AbstractScanner
+
+MODELS = [Person, Device, DeviceLastSeen]
+
+
+def make_hosts(count):
+    return [("02:00:00:%02x:%02x:%02x" % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+             "10.%d.%d.%d" % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff))
+            for i in range(count)]
+
+
+def cycle_hosts(hosts, cycle):
+    return [h for i, h in enumerate(hosts) if (i + cycle) % 10 != 0]
+
+
+def expected_intervals(hosts, timestamps):
+    # (mac_addr, ip_addr, first_seen, last_seen) of every interval the cycles should leave
+    intervals = []
+    open_intervals = {}
+    for cycle, timestamp in enumerate(timestamps):
+        present = set(cycle_hosts(hosts, cycle))
+        for host in list(open_intervals):
+            if host not in present:
+                intervals.append(host + tuple(open_intervals.pop(host)))
+        for host in present:
+            open_intervals.setdefault(host, [timestamp, None])[1] = timestamp
+    intervals.extend(host + tuple(interval) for host, interval in open_intervals.items())
+    return sorted(intervals)
+
+
+def ingest_per_row(scanner, hosts, timestamp):
+    partition = partitions.get(timestamp, create=True)
+    for mac_addr, ip_addr in hosts:
+        updated = partition\
+            .update(last_seen=timestamp)\
+            .where((partition.mac_addr == mac_addr) & (partition.ip_addr == ip_addr) &
+                   (partition.last_seen == scanner.last_scan))\
+            .execute()
+        if not updated:
+            partition.create(mac_addr=mac_addr, ip_addr=ip_addr, first_seen=timestamp, last_seen=timestamp)
+        DeviceLastSeen\
+            .insert(mac_addr=mac_addr, ip_addr=ip_addr, last_seen=timestamp)\
+            .on_conflict(conflict_target=[DeviceLastSeen.mac_addr],
+                         preserve=[DeviceLastSeen.ip_addr, DeviceLastSeen.last_seen])\
+            .execute()
+    scanner.last_scan = timestamp
+
+
+def ingest_batched(scanner, hosts, timestamp):
+    scanner.save_scan_results(hosts, timestamp)
+
+
+def run(name, fn, hosts, cycles):
+    # Starts at the beginning of a month, so that all the cycles go to one partition
+    start_time = datetime(2024, 1, 1)
+    timestamps = [start_time + timedelta(minutes=i) for i in range(cycles)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.init(os.path.join(tmp, "bench.db"))
+        db.create_tables(MODELS)
+        partitions.reload()
+
+        scanner = AbstractScanner(60)
+        scanner.known_devices = {mac_addr for mac_addr, _ in hosts}
+
+        rows = 0
+        start = time.perf_counter()
+        for cycle, timestamp in enumerate(timestamps):
+            present = cycle_hosts(hosts, cycle)
+            fn(scanner, present, timestamp)
+            rows += len(present)
+        elapsed = time.perf_counter() - start
+
+        partition = partitions.get(start_time)
+        stored = sorted(partition
+                        .select(partition.mac_addr, partition.ip_addr, partition.first_seen, partition.last_seen)
+                        .tuples())
+        assert stored == expected_intervals(hosts, timestamps), "%s stored wrong intervals" % name
+        assert DeviceLastSeen.select().count() == len(hosts), "%s stored wrong last seen rows" % name
+
+        db.close()
+
+    print("%-10s %8d rows in %7.3f s  %10.0f rows/s  %6d intervals" % (name, rows, elapsed, rows / elapsed, len(stored)))
+
+
+def main():
+    host_count = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    hosts = make_hosts(host_count)
+
+    run("per-row", ingest_per_row, hosts, cycles)
+    run("batched", ingest_batched, hosts, cycles)
+
+
+if __name__ == "__main__":
+    main()
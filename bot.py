@@ -1,5 +1,10 @@
+import json
 import re
 import threading
+import time
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 import telebot
 
 
@@ -25,7 +30,71 @@ def build_keyboard(buttons, inline=False):
     return markup
 
 
+class LRUCache:
+    # Bounded mapping: the least recently used entries are evicted when it is full, and entries not used
+    # for ttl seconds expire
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if self.ttl is not None and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                return default
+            self._data[key] = (time.monotonic(), item[1])
+            self._data.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+def dump_fields(obj):
+    # Attributes set by handlers or `setup`, everything else comes from the class
+    return {k: v for k, v in vars(obj).items() if k != "chat"}
+
+
+def buttons_table(buttons):
+    return MappingProxyType({label: row[label] for row in buttons for label in row})
+
+
+def action_table(cls, actions):
+    # label -> function, for the actions given by method name or as ("callback", method name)
+    table = {}
+    for key, action in actions.items():
+        if isinstance(action, tuple):
+            if action[0] != "callback":
+                continue
+            action = action[1]
+        table[key] = getattr(cls, action)
+    return MappingProxyType(table)
+
+
 class BotState:
+    # Subclasses are registered by name, so that a chat's state can be saved and restored.
+    # The dispatch tables and the reply keyboard of each class are built once, when it is defined.
+    registry = {}
 
     buttons = []
     commands = {}
@@ -35,14 +104,22 @@ class BotState:
         "is_personal": True,
     }
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        BotState.registry[cls.__name__] = cls
+        cls.compile()
+
+    @classmethod
+    def compile(cls):
+        cls.buttons_dict = buttons_table(cls.buttons or [])
+        cls.command_actions = action_table(cls, cls.commands)
+        cls.button_actions = action_table(cls, cls.buttons_dict)
+        cls.pattern_actions = tuple((re.compile(p), getattr(cls, a)) for p, a in cls.patterns.items())
+        cls.markup = build_keyboard(cls.buttons).to_json() if cls.buttons is not None else None
+
     def __init__(self, chat):
         self.chat = chat
 
-        self.buttons_dict = {}
-        for row in self.buttons:
-            for label in row:
-                self.buttons_dict[label] = row[label]
-
     def default(self, text):
         pass
 
@@ -51,29 +128,111 @@ class BotState:
 
 
 class InlineKeyboard:
+    # Keyboards of sent messages are kept as (class name, fields) and created again when a button is pressed.
+    # Like BotState, each class is compiled when it is defined.
+    #
+    # Keyboards whose buttons depend on their fields override build_markup() and give their buttons
+    # "name|argument" callback data, `callbacks` maps the name to a method called with (query, argument).
+    registry = {}
 
     buttons = []
+    callbacks = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        InlineKeyboard.registry[cls.__name__] = cls
+        cls.compile()
+
+    @classmethod
+    def compile(cls):
+        cls.buttons_dict = buttons_table(cls.buttons or [])
+        cls.callback_actions = action_table(cls, cls.buttons_dict)
+        cls.argument_actions = action_table(cls, cls.callbacks)
+        cls.markup = build_keyboard(cls.buttons, inline=True).to_json() if cls.buttons is not None else None
 
     def __init__(self, chat):
         self.chat = chat
 
-        self.buttons_dict = {}
-        for row in self.buttons:
-            for label in row:
-                self.buttons_dict[label] = row[label]
+    def build_markup(self):
+        return self.markup
+
+    def dispatch(self, query):
+        action = self.callback_actions.get(query.data)
+        if action is not None:
+            return action(self, query)
+
+        name, separator, argument = query.data.partition("|")
+        action = self.argument_actions.get(name)
+        if separator and action is not None:
+            return action(self, query, argument)
+
+
+BotState.compile()
+InlineKeyboard.compile()
+InlineKeyboard.registry[InlineKeyboard.__name__] = InlineKeyboard
 
 
 class ChatFSM:
-    def __init__(self, bot, chat_id):
+    def __init__(self, bot, chat_id, store=None, max_keyboards=100, keyboard_ttl=None):
         self.bot = bot
         self.chat_id = chat_id
+        self.store = store
         self.state = None
         self.storage = {}
-        self.keyboards = {}
+        # message_id -> (keyboard class name, fields)
+        self.keyboards = LRUCache(max_keyboards, keyboard_ttl)
 
     def set_state(self, state):
         self.state = state(self)
 
+    def dump(self):
+        return json.dumps({
+            "state": type(self.state).__name__,
+            "fields": dump_fields(self.state),
+            "storage": self.storage,
+        }, separators=(",", ":"))
+
+    def restore(self, data):
+        data = json.loads(data)
+        self.state = state = BotState.registry[data["state"]](self)
+        for field, value in data["fields"].items():
+            setattr(state, field, value)
+        self.storage = data["storage"]
+
+    def save(self):
+        if self.store is not None:
+            try:
+                self.store.save_chat(self.chat_id, self.dump())
+            except Exception as e:
+                print("Failed to save chat#%s: %r" % (self.chat_id, e))
+
+    def _remember_keyboard(self, message_id, keyboard):
+        # The message has been sent already, a failure here only leaves its buttons not working,
+        # so it isn't raised: callers would take the message for not sent and send it again
+        try:
+            data = (type(keyboard).__name__, dump_fields(keyboard))
+            self.keyboards.put(message_id, data)
+            if self.store is not None:
+                self.store.save_keyboard(self.chat_id, message_id, json.dumps(data, separators=(",", ":")))
+        except Exception as e:
+            print("Failed to save keyboard of message#%s: %r" % (message_id, e))
+
+    def get_keyboard(self, message_id):
+        data = self.keyboards.get(message_id)
+        if data is None and self.store is not None:
+            stored = self.store.load_keyboard(self.chat_id, message_id)
+            if stored is not None:
+                data = tuple(json.loads(stored))
+                self.keyboards.put(message_id, data)
+        if data is None:
+            return None
+
+        name, fields = data
+        keyboard = InlineKeyboard.registry[name](self)
+        for field, value in fields.items():
+            setattr(keyboard, field, value)
+        return keyboard
+
     def message(self, msg):
         state = self.state
 
@@ -84,42 +243,34 @@ class ChatFSM:
 
             matched = False
 
-            if cmd_name in state.commands:
-                matched = True
-                action_name = state.commands.get(cmd_name)
-                action = getattr(state, action_name)
-                action(cmd_args)
-            elif text in state.buttons_dict:
+            action = state.command_actions.get(cmd_name)
+            if action is not None:
                 matched = True
-                action_name = state.buttons_dict.get(text)
-                action = getattr(state, action_name)
-                action()
+                action(state, cmd_args)
             else:
-                for pattern in state.patterns:
-                    match = re.search(pattern, text)
-                    if not match:
-                        continue
+                action = state.button_actions.get(text)
+                if action is not None:
                     matched = True
-
-                    action_name = state.patterns.get(pattern)
-                    action = getattr(state, action_name)
-                    action(text)
+                    action(state)
+                else:
+                    for pattern, action in state.pattern_actions:
+                        if not pattern.search(text):
+                            continue
+                        matched = True
+                        action(state, text)
 
             if not matched:
                 state.default(text)
 
-    def callback_query(self, query):
-        data = query.data
-        keyboard = self.keyboards[query.message.message_id]
-        action_setup = keyboard.buttons_dict.get(data)
-
-        if isinstance(action_setup, tuple) and action_setup[0] == "callback":
-            action_name = action_setup[1]
-        else:
-            action_name = str(action_setup)
+        self.save()
 
-        action = getattr(keyboard, action_name)
-        action(query)
+    def callback_query(self, query):
+        keyboard = self.get_keyboard(query.message.message_id)
+        if keyboard is None:
+            self.bot.answer_callback_query(query.id, "This button has expired")
+            return
+        keyboard.dispatch(query)
+        self.save()
 
     def inline_query(self, query):
         results = self.state.inline_query(query)
@@ -133,7 +284,7 @@ class ChatFSM:
             if reply_markup is not None:
                 raise Exception("Reply markup is already set. Unable to change state.")
 
-            reply_markup = build_keyboard(new_state.buttons)
+            reply_markup = new_state.markup
 
         self.bot.send_message(self.chat_id, text,
                               parse_mode=parse_mode,
@@ -151,10 +302,11 @@ class ChatFSM:
     def inline(self, text, markup=None, setup=None, parse_mode=None, disable_web_page_preview=None,
                disable_notification=None, reply_to_message_id=None, reply_markup=None):
 
-        if markup is not None and markup.buttons is not None:
+        m = self._make_keyboard(markup, setup)
+        if m is not None:
             if reply_markup is not None:
                 raise Exception("Reply markup is already set. Unable to init inline keyboard.")
-            reply_markup = build_keyboard(markup.buttons, inline=True)
+            reply_markup = m.build_markup()
 
         reply = self.bot.send_message(self.chat_id, text,
                                       parse_mode=parse_mode,
@@ -163,22 +315,23 @@ class ChatFSM:
                                       reply_to_message_id=reply_to_message_id,
                                       reply_markup=reply_markup)
 
-        if markup is not None and markup.buttons is not None:
-            self.keyboards[reply.message_id] = m = markup(self)
-            if setup is not None:
-                for field in setup:
-                    setattr(m, field, setup[field])
+        if m is not None:
+            self._remember_keyboard(reply.message_id, m)
 
     def edit(self, message_id, text=None, markup=None, setup=None, parse_mode=None,
              disable_web_page_preview=None, reply_markup=None):
 
         if markup is None and reply_markup is None:
-            markup = self.keyboards.get(message_id, None)
+            keyboard = self.get_keyboard(message_id)
+            if keyboard is not None:
+                markup = type(keyboard)
+                setup = dump_fields(keyboard) if setup is None else setup
 
-        if markup is not None and markup.buttons is not None:
+        m = self._make_keyboard(markup, setup)
+        if m is not None:
             if reply_markup is not None:
                 raise Exception("Reply markup is already set. Unable to init inline keyboard.")
-            reply_markup = build_keyboard(markup.buttons, inline=True)
+            reply_markup = m.build_markup()
 
         if text is not None:
             self.bot.edit_message_text(text,
@@ -192,27 +345,172 @@ class ChatFSM:
                                                message_id=message_id,
                                                reply_markup=reply_markup)
 
-        if markup is not None and markup.buttons is not None:
-            self.keyboards[message_id] = m = markup(self)
-            if setup is not None:
-                for field in setup:
-                    setattr(m, field, setup[field])
+        if m is not None:
+            self._remember_keyboard(message_id, m)
+
+    def _make_keyboard(self, markup, setup):
+        if markup is None or markup.buttons is None:
+            return None
+        m = markup(self)
+        if setup is not None:
+            for field in setup:
+                setattr(m, field, setup[field])
+        return m
+
+
+class ChatDispatcher:
+    # Runs handlers on a thread pool. Updates of one chat are handled one after another in the order
+    # they came, different chats are handled in parallel. At most max_pending updates may wait or run,
+    # then submit() blocks the polling thread, so Telegram holds the rest of the updates.
+    # A handler running longer than timeout seconds can't be interrupted, so the chat stays busy until
+    # it returns: the updates waiting for it are dropped, and so are new ones of the chat meanwhile.
+    # on_drop(chat_id, count) is then called on the pool to tell the chat, e.g. to ask it to retry.
+
+    def __init__(self, workers=4, max_pending=100, timeout=60, on_drop=None):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="bot-handler")
+        self.timeout = timeout
+        self.on_drop = on_drop
+        self._slots = threading.BoundedSemaphore(max_pending)
+        # chat_id -> updates waiting for the running one, present while a handler of the chat runs
+        self._queues = {}
+        # chat_id -> (deadline, handler) of the handlers running now
+        self._running = {}
+        # Chats whose running handler is past its deadline
+        self._timed_out = set()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self.watchdog = threading.Thread(target=self._watch, name="bot-watchdog", daemon=True)
+        self.watchdog.start()
+
+        self.handled = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.dropped = 0
+
+    def submit(self, chat_id, fn, *args):
+        self._slots.acquire()
+        with self._cond:
+            if chat_id in self._timed_out:
+                self._drop(chat_id, 1)
+                return
+            queue = self._queues.get(chat_id)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._queues[chat_id] = deque()
+        self.executor.submit(self._call, chat_id, fn, args)
+
+    def _call(self, chat_id, fn, args):
+        with self._cond:
+            self._running[chat_id] = (time.monotonic() + self.timeout, fn)
+            self._cond.notify_all()
+        try:
+            fn(*args)
+            self.handled += 1
+        except Exception as e:
+            self.errors += 1
+            print("Handler %s failed for chat#%s: %r" % (fn.__name__, chat_id, e))
+        finally:
+            self._slots.release()
+            self._next(chat_id)
+
+    def _next(self, chat_id):
+        with self._cond:
+            del self._running[chat_id]
+            self._timed_out.discard(chat_id)
+            queue = self._queues[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+                # stop() may be waiting for the queues to drain
+                self._cond.notify_all()
+                return
+            fn, args = queue.popleft()
+        self.executor.submit(self._call, chat_id, fn, args)
+
+    def _watch(self):
+        # One thread keeps the deadlines of all running handlers
+        with self._cond:
+            while not self._stopped:
+                now = time.monotonic()
+                wait = None
+                for chat_id, (deadline, fn) in self._running.items():
+                    if chat_id in self._timed_out:
+                        continue
+                    if deadline <= now:
+                        self._timed_out.add(chat_id)
+                        self.timeouts += 1
+                        print("Handler %s for chat#%s is running longer than %s s" % (fn.__name__, chat_id, self.timeout))
+                        queue = self._queues.get(chat_id)
+                        if queue:
+                            self._drop(chat_id, len(queue))
+                            queue.clear()
+                    elif wait is None or deadline - now < wait:
+                        wait = deadline - now
+                self._cond.wait(wait)
+
+    def _drop(self, chat_id, count):
+        # Called with the lock held
+        for _ in range(count):
+            self._slots.release()
+        self.dropped += count
+        fn = self._running[chat_id][1]
+        print("Dropped %d update(s) for chat#%s, handler %s is still running" % (count, chat_id, fn.__name__))
+        if self.on_drop is not None:
+            # Not under the lock, and not on the polling thread
+            self.executor.submit(self._notify_drop, chat_id, count)
+
+    def _notify_drop(self, chat_id, count):
+        try:
+            self.on_drop(chat_id, count)
+        except Exception as e:
+            print("Failed to notify chat#%s of dropped updates: %r" % (chat_id, e))
+
+    def pending(self):
+        with self._cond:
+            return sum(len(q) + 1 for q in self._queues.values())
+
+    def stop(self):
+        # Telegram won't send the updates again once they are received, so the queued ones are still
+        # handled. The watchdog keeps dropping the updates of chats stuck meanwhile.
+        with self._cond:
+            while self._queues:
+                self._cond.wait()
+            self._stopped = True
+            self._cond.notify_all()
+        self.watchdog.join()
+        self.executor.shutdown(wait=True)
 
 
 class TelegramBot:
-    def __init__(self, token, initial_state):
-        self.allowed_chats = []
+    # Chats not used for a while are evicted from memory. With a store (see state_store.SqliteStateStore)
+    # their state and inline keyboards are saved and loaded again on the next update.
 
-        self.bot = telebot.TeleBot(token=token)
-        self.bot.register_message_handler(self.on_chat_message, content_types=['text'])
-        self.bot.register_callback_query_handler(self.on_callback_query, lambda _: True)
-        self.bot.register_inline_handler(self.on_inline_query, lambda _: True)
-        self.bot.register_chosen_inline_handler(self.on_chosen_inline_result, lambda _: True)
+    def __init__(self, token, initial_state, workers=4, max_pending=100, handler_timeout=60, store=None,
+                 max_chats=1000, chat_ttl=None, max_keyboards=100, keyboard_ttl=None):
+        self.allowed_chats = []
 
         self.initial_state = initial_state
-        self.chats = {}
+        self.store = store
+        self.max_keyboards = max_keyboards
+        self.keyboard_ttl = keyboard_ttl
+        self.chats = LRUCache(max_chats, chat_ttl)
+        self._chats_lock = threading.Lock()
+        self.dispatcher = ChatDispatcher(workers, max_pending, handler_timeout, self.on_updates_dropped)
+
+        self.bot = self.create_client(token)
 
-        self.polling_thread = threading.Thread(target=self.bot.infinity_polling)
+    def create_client(self, token):
+        # Returns the object ChatFSM sends requests with (send_message, edit_message_text, ...)
+
+        # Updates are handed to the dispatcher in the order they came, telebot's own workers would reorder them
+        bot = telebot.TeleBot(token=token, threaded=False)
+        bot.register_message_handler(self.on_chat_message, content_types=['text'])
+        bot.register_callback_query_handler(self.on_callback_query, lambda _: True)
+        bot.register_inline_handler(self.on_inline_query, lambda _: True)
+        bot.register_chosen_inline_handler(self.on_chosen_inline_result, lambda _: True)
+
+        self.polling_thread = threading.Thread(target=bot.infinity_polling)
+        return bot
 
     def start(self):
         self.polling_thread.start()
@@ -220,17 +518,48 @@ class TelegramBot:
     def stop(self):
         self.bot.stop_bot()
         self.polling_thread.join()
+        self.dispatcher.stop()
+
+    def on_updates_dropped(self, chat_id, count):
+        self.bot.send_message(chat_id, "⏳ Still busy with your previous request, please retry later")
 
     def allow_chat(self, chat_id):
         self.allowed_chats.append(chat_id)
 
     def get_or_create_chat(self, chat_id):
-        if chat_id not in self.chats:
-            self.chats[chat_id] = chat = ChatFSM(self.bot, chat_id)
+        with self._chats_lock:
+            chat = self.chats.get(chat_id)
+            if chat is not None:
+                return chat
+
+            chat = ChatFSM(self.bot, chat_id, self.store, self.max_keyboards, self.keyboard_ttl)
             chat.set_state(self.initial_state)
+            data = self.store.load_chat(chat_id) if self.store is not None else None
+            if data is not None:
+                try:
+                    chat.restore(data)
+                except (KeyError, ValueError) as e:
+                    print("Failed to restore chat#%s: %r" % (chat_id, e))
+                    chat.set_state(self.initial_state)
+
+            self.chats.put(chat_id, chat)
             return chat
-        else:
-            return self.chats[chat_id]
+
+    def handle(self, chat_id, action, update):
+        # The chat is looked up when the update is handled, it may have been evicted since it came
+        getattr(self.get_or_create_chat(chat_id), action)(update)
+
+    def process_update(self, update):
+        # For transports that receive raw updates themselves
+        if update.message is not None:
+            if update.message.content_type == 'text':
+                self.on_chat_message(update.message)
+        elif update.callback_query is not None:
+            self.on_callback_query(update.callback_query)
+        elif update.inline_query is not None:
+            self.on_inline_query(update.inline_query)
+        elif update.chosen_inline_result is not None:
+            self.on_chosen_inline_result(update.chosen_inline_result)
 
     def on_chat_message(self, msg):
         chat_id = msg.chat.id
@@ -240,8 +569,7 @@ class TelegramBot:
             print("Access denied for chat#{}".format(chat_id))
             return
 
-        chat = self.get_or_create_chat(chat_id)
-        chat.message(msg)
+        self.dispatcher.submit(chat_id, self.handle, chat_id, "message", msg)
 
     def on_callback_query(self, query):
         chat_id = query.message.chat.id
@@ -249,8 +577,7 @@ class TelegramBot:
         if chat_id not in self.allowed_chats:
             return
 
-        chat = self.get_or_create_chat(chat_id)
-        chat.callback_query(query)
+        self.dispatcher.submit(chat_id, self.handle, chat_id, "callback_query", query)
 
     def on_inline_query(self, query):
         chat_id = query.from_user.id
@@ -258,8 +585,7 @@ class TelegramBot:
         if chat_id not in self.allowed_chats:
             return
 
-        chat = self.get_or_create_chat(chat_id)
-        chat.inline_query(query)
+        self.dispatcher.submit(chat_id, self.handle, chat_id, "inline_query", query)
 
     def on_chosen_inline_result(self, query):
         print(">> " + query.query)
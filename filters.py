@@ -0,0 +1,102 @@
+from bisect import bisect_right
+from ipaddress import ip_address, ip_network
+
+
+class IntervalSet:
+    # Sorted disjoint [start, end] ranges of integers, membership is checked with a binary search
+    def __init__(self, ranges):
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(ranges):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, value):
+        i = bisect_right(self.starts, value) - 1
+        return i >= 0 and value <= self.ends[i]
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def mac_to_int(mac_addr):
+    return int(mac_addr.replace(":", "").replace("-", "").replace(".", ""), 16)
+
+
+def mac_prefix_range(prefix):
+    # "00:1a:2b" -> all MAC addresses starting with these digits
+    digits = prefix.replace(":", "").replace("-", "").replace(".", "").lower()
+    shift = 4 * (12 - len(digits))
+    start = int(digits, 16) << shift if digits else 0
+    return start, start + (1 << shift) - 1
+
+
+class AddressRules:
+    # CIDRs of both IP versions and MAC prefixes of one kind (included or excluded)
+    def __init__(self, cidrs=None, macs=None, interfaces=None):
+        networks = [ip_network(c, strict=False) for c in cidrs or []]
+        self.ipv4 = IntervalSet((int(n.network_address), int(n.broadcast_address))
+                                for n in networks if n.version == 4)
+        self.ipv6 = IntervalSet((int(n.network_address), int(n.broadcast_address))
+                                for n in networks if n.version == 6)
+        self.macs = IntervalSet(mac_prefix_range(p) for p in macs or [])
+        self.interfaces = frozenset(interfaces or [])
+
+        self.has_ips = bool(networks)
+        self.has_macs = bool(macs)
+        self.has_interfaces = bool(interfaces)
+
+    def match_ip(self, addr):
+        return int(addr) in (self.ipv4 if addr.version == 4 else self.ipv6)
+
+    def match_mac(self, mac_addr):
+        return mac_to_int(mac_addr) in self.macs
+
+
+class HostFilter:
+    # Include rules of each kind (CIDRs, MAC prefixes, interfaces) that are set must all match,
+    # any rule of a kind is enough. A host matching any exclude rule is dropped.
+
+    def __init__(self, include=None, exclude=None, include_macs=None, exclude_macs=None,
+                 interfaces=None, exclude_interfaces=None):
+        self.include = AddressRules(include, include_macs, interfaces)
+        self.exclude = AddressRules(exclude, exclude_macs, exclude_interfaces)
+
+    @classmethod
+    def from_settings(cls, settings):
+        if not settings:
+            return None
+        return cls(**settings)
+
+    def match(self, mac_addr, ip_addr, interface=None):
+        inc, exc = self.include, self.exclude
+
+        if inc.has_ips or exc.has_ips:
+            try:
+                addr = ip_address(ip_addr)
+            except ValueError:
+                return False
+            if inc.has_ips and not inc.match_ip(addr):
+                return False
+            if exc.has_ips and exc.match_ip(addr):
+                return False
+
+        if inc.has_macs or exc.has_macs:
+            if inc.has_macs and not inc.match_mac(mac_addr):
+                return False
+            if exc.has_macs and exc.match_mac(mac_addr):
+                return False
+
+        if inc.has_interfaces and interface not in inc.interfaces:
+            return False
+        if exc.has_interfaces and interface in exc.interfaces:
+            return False
+
+        return True
+
+    def apply(self, hosts):
+        # hosts are (mac_addr, ip_addr) or (mac_addr, ip_addr, interface) tuples
+        return [h for h in hosts if self.match(*h)]
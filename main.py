@@ -9,13 +9,23 @@ from datetime import datetime, timedelta
 from itertools import groupby
 from time import sleep
 
-from telebot.types import InlineQueryResultArticle, InputTextMessageContent
+from telebot.types import InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, \
+    InlineKeyboardButton
 from bot import TelegramBot, BotState, InlineKeyboard
+from async_bot import AsyncTelegramBot
 
-from models import Person, Device, ScanResult
-from peewee import fn, JOIN, SQL, NodeList
+from models import Person, Device, DeviceLastSeen
+from migrations import migrate
+from writer import writer
+from state_store import SqliteStateStore
+from peewee import JOIN
 from arping_scanner import ARPScanner
 from routeros_scanner import RouterOsScanner
+from scanner import ScannerGroup
+from filters import HostFilter
+from retention import RetentionJob
+from alerts import AlertDispatcher
+from search import NameIndex
 
 
 def format_datetime(dt):
@@ -39,6 +49,14 @@ CMD_ADD_PERSON = "Add person"
 CMD_ADD_DEVICE = "Add device"
 CMD_REGISTER = "➕ Register"
 CMD_SEARCH = "🔍 Search"
+CMD_NEWER = "◀ Newer"
+CMD_OLDER = "Older ▶"
+
+# Owner search of the inline queries, loaded on start
+people = NameIndex()
+
+# Devices per page of the reports, keeps messages well below Telegram's 4096 characters
+REPORT_PAGE_SIZE = 30
 
 
 class BotMainState(BotState):
@@ -63,30 +81,27 @@ class BotMainState(BotState):
         self.chat.reply("It works", new_state=BotMainState)
 
     def get_conn_devices(self):
-        if scanner.last_scan is None:
+        snapshot = scanner.snapshot
+        if snapshot is None:
             self.chat.reply("Scanner is not started yet")
             return
 
-        all_results = ScanResult\
-            .filter(ScanResult.time == scanner.last_scan)\
-            .join(Device, JOIN.LEFT_OUTER)
         anon_results = []
 
-        msg_text = "Connected devices as of %s\n" % scanner.last_scan.strftime("%Y.%m.%d %X")
+        msg_text = "Connected devices as of %s\n" % snapshot.time.strftime("%Y.%m.%d %X")
 
-        if len(all_results) > 0:
+        if len(snapshot.hosts) > 0:
             msg_text += "\nKnown devices:\n"
-            for r in all_results:
-                if r.device:
-                    d = r.device
-                    msg_text += "%s: %s\n" % (d.owner.name if d.owner else "<b>N/A</b>", d.name or "<b>N/A</b>")
+            for h in snapshot.hosts:
+                if h.registered:
+                    msg_text += "%s: %s\n" % (h.owner or "<b>N/A</b>", h.device or "<b>N/A</b>")
                 else:
-                    anon_results.append(r)
+                    anon_results.append(h)
 
         if len(anon_results) > 0:
             msg_text += "\nUnknown devices:\n<code>"
-            for r in anon_results:
-                msg_text += "%s %s\n" % (r.mac_addr, r.ip_addr)
+            for h in anon_results:
+                msg_text += "%s %s\n" % (h.mac_addr, h.ip_addr)
             msg_text += "</code>"
 
         self.chat.reply(
@@ -97,80 +112,16 @@ class BotMainState(BotState):
     def get_last1h_devices(self):
         if scanner.last_scan is None:
             self.chat.reply("⚠️ Scanner is not started yet")
+            return
 
-        now = datetime.now()
-
-        results = ScanResult\
-            .select()\
-            .where(ScanResult.time > now - timedelta(hours=1))\
-            .join(Device, JOIN.LEFT_OUTER)\
-            .join(Person, JOIN.LEFT_OUTER)\
-            .group_by(ScanResult.mac_addr)\
-            .having(fn.Max(ScanResult.time) == ScanResult.time)\
-            .order_by(-ScanResult.time, NodeList((Person.name, SQL('IS NULL'))), Person.name)
-
-        msg_text = "Active in the last hour devices list\nAs of %s\n" % now.strftime("%Y.%m.%d %X")
-
-        for k, g in groupby(results, lambda x: x.time):
-            age = int((now - k).seconds / 60)
-            msg_text += "\n<b>%s min ago</b>\n" % str(age) if age > 0 else "\n<b>Now</b>\n"
-            for r in g:
-                if r.device:
-                    d = r.device
-                    msg_text += "• %s (%s) \n" % (
-                        d.owner.name if d.owner else "N/A",
-                        d.name or "N/A"
-                    )
-                else:
-                    msg_text += "• <code>%s</code>\n" % r.mac_addr
-
-        self.chat.reply(
-            msg_text,
-            parse_mode='HTML',
-        )
+        show_report(self.chat, "last1h", datetime.now())
 
     def get_recent_devices_activity(self):
         if scanner.last_scan is None:
             self.chat.reply("⚠️ Scanner is not started yet")
+            return
 
-        results = ScanResult\
-            .select()\
-            .join(Device, JOIN.LEFT_OUTER)\
-            .group_by(ScanResult.mac_addr)\
-            .having(fn.Max(ScanResult.time) == ScanResult.time)\
-            .order_by(-ScanResult.time, -Device.owner)
-
-        now = datetime.now()
-        for r in results:
-            interval = (now.date() - r.time.date()).days
-            if interval >= 7:
-                r.interval_readable = "Long time ago"
-            elif interval >= 2:
-                r.interval_readable = "Last week"
-            elif interval >= 1:
-                r.interval_readable = "Yesterday"
-            else:
-                r.interval_readable = "Today"
-
-        msg_text = "Recent active devices list\nAs of %s\n" % now.strftime("%Y.%m.%d %X")
-
-        for k, g in groupby(results, lambda x: x.interval_readable):
-            msg_text += "\n<b>%s</b>\n" % k
-            for r in g:
-                if r.device:
-                    d = r.device
-                    msg_text += "%s: %s (%s) \n" % (
-                        format_datetime(r.time),
-                        d.owner.name if d.owner else "N/A",
-                        d.name or "N/A"
-                    )
-                else:
-                    msg_text += "%s: <code>%s</code>\n" % (format_datetime(r.time), r.mac_addr)
-
-        self.chat.reply(
-            msg_text,
-            parse_mode='HTML',
-        )
+        show_report(self.chat, "history", datetime.now())
 
     def add_person(self):
         self.chat.reply(
@@ -199,7 +150,9 @@ class BotAddPersonState(BotState):
     buttons = [{CMD_CANCEL: "cancel"}]
 
     def default(self, text):
-        Person(name=text).save()
+        person = Person(name=text)
+        writer.run(person.save)
+        people.add(person.id, person.name)
         self.chat.reply(
             "Person has been saved",
             new_state=BotMainState,
@@ -215,6 +168,12 @@ class BotAddPersonState(BotState):
 class BotAddDeviceState(BotState):
     buttons = [{CMD_CANCEL: "cancel"}]
 
+    inline_query_kwargs = {
+        "is_personal": True,
+        # Answers may be cached by Telegram this long, a person added meanwhile shows up after that
+        "cache_time": 10,
+    }
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.mac_addr = None
@@ -244,9 +203,10 @@ class BotAddDeviceState(BotState):
         else:
             try:
                 owner = Person.get(Person.name == text)
+                # History isn't touched, owners are looked up by MAC address when it is read
                 dev = Device(mac_addr=self.mac_addr, name=self.name, owner=owner)
-                dev.save()
-                ScanResult.update(device=dev).where(ScanResult.mac_addr == self.mac_addr).execute()
+                writer.run(dev.save)
+                scanner.update_device(dev)
                 self.chat.reply(
                     "Device has been saved",
                     new_state=BotMainState,
@@ -264,23 +224,45 @@ class BotAddDeviceState(BotState):
         )
 
     def inline_query(self, query):
-        data = query.query.lstrip()
         results = []
         if self.mac_addr is not None and self.name is not None:
-            print("\"%s\"" % data)
-            users = Person.select().where(Person.name.contains(data))
-
-            for user in users:
+            for person_id, name in people.search(query.query):
                 results.append(InlineQueryResultArticle(
-                    id=user.name,
-                    title=user.name,
-                    input_message_content=InputTextMessageContent(user.name)
+                    id=str(person_id),
+                    title=name,
+                    input_message_content=InputTextMessageContent(name)
                 ))
 
         return results
 
 
+def start_device_registration(chat, mac_addr):
+    # Returns False if the device is registered already
+    try:
+        device = Device.get(Device.mac_addr == mac_addr)
+        chat.reply(
+            "This device is registered already\n"
+            "MAC address: %s\n"
+            "Name: %s\n"
+            "Owner: %s" % (device.mac_addr, device.name, device.owner.name)
+        )
+        return False
+    except Device.DoesNotExist:
+        pass
+
+    chat.reply(
+        "Device registration (step 2/3).\n"
+        "MAC address: %s\n"
+        "\n"
+        "Please, name this device." % mac_addr,
+        new_state=BotAddDeviceState,
+        setup={"mac_addr": mac_addr},
+    )
+    return True
+
+
 class NewDeviceAlertKeyboard(InlineKeyboard):
+    # Alerts about a single device sent before digests, kept for their buttons to keep working
     buttons = [{
         CMD_REGISTER: ("callback", "register"),
     }]
@@ -290,29 +272,185 @@ class NewDeviceAlertKeyboard(InlineKeyboard):
         self.mac_addr = None
 
     def register(self, query):
-        msg_id = query.message.message_id
+        if not start_device_registration(self.chat, self.mac_addr):
+            self.chat.edit(query.message.message_id, markup=InlineKeyboard)
 
-        try:
-            device = Device.get(Device.mac_addr == self.mac_addr)
-            self.chat.reply(
-                "This device is registered already\n"
-                "MAC address: %s\n"
-                "Name: %s\n"
-                "Owner: %s" % (device.mac_addr, device.name, device.owner.name)
+
+class NewDevicesKeyboard(InlineKeyboard):
+    # A register button for each device of a new devices digest
+    callbacks = {"register": "register"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mac_addrs = []
+
+    def build_markup(self):
+        markup = InlineKeyboardMarkup()
+        for mac_addr in self.mac_addrs:
+            markup.row(InlineKeyboardButton("%s %s" % (CMD_REGISTER, mac_addr), callback_data="register|" + mac_addr))
+        return markup
+
+    def register(self, query, mac_addr):
+        if not start_device_registration(self.chat, mac_addr):
+            self.chat.edit(
+                query.message.message_id,
+                markup=NewDevicesKeyboard,
+                setup={"mac_addrs": [m for m in self.mac_addrs if m != mac_addr]},
             )
-            self.chat.edit(msg_id, markup=InlineKeyboard)
-            return
-        except Device.DoesNotExist:
-            pass
 
-        self.chat.reply(
-            "Device registration (step 2/3).\n"
-            "MAC address: %s\n"
-            "\n"
-            "Please, name this device." % self.mac_addr,
-            new_state=BotAddDeviceState,
-            setup={"mac_addr": self.mac_addr},
-        )
+
+def fetch_report_page(since, cursor=None, backward=False, size=REPORT_PAGE_SIZE):
+    # A page of devices seen after since, newest first, ordered by (last_seen, mac_addr) so that pages
+    # are found by the key of their neighbour row instead of an offset. cursor is the key of the last
+    # row of the previous page, or of the first row of the next one when going backward.
+    # There is no upper bound: a device seen again since the previous page moves to the first page.
+    # Returns the rows and whether there are more rows further in that direction.
+    query = DeviceLastSeen\
+        .select(DeviceLastSeen, Device, Person)\
+        .join(Device, JOIN.LEFT_OUTER, on=(Device.mac_addr == DeviceLastSeen.mac_addr), attr='device')\
+        .join(Person, JOIN.LEFT_OUTER)
+    if since is not None:
+        query = query.where(DeviceLastSeen.last_seen > since)
+
+    if cursor is not None:
+        last_seen, mac_addr = datetime.fromisoformat(cursor[0]), cursor[1]
+        if backward:
+            query = query.where((DeviceLastSeen.last_seen > last_seen) |
+                                ((DeviceLastSeen.last_seen == last_seen) & (DeviceLastSeen.mac_addr > mac_addr)))
+        else:
+            query = query.where((DeviceLastSeen.last_seen < last_seen) |
+                                ((DeviceLastSeen.last_seen == last_seen) & (DeviceLastSeen.mac_addr < mac_addr)))
+
+    if backward:
+        query = query.order_by(DeviceLastSeen.last_seen, DeviceLastSeen.mac_addr)
+    else:
+        query = query.order_by(-DeviceLastSeen.last_seen, -DeviceLastSeen.mac_addr)
+
+    rows = list(query.limit(size + 1))
+    more = len(rows) > size
+    rows = rows[:size]
+    if backward:
+        rows.reverse()
+    return rows, more
+
+
+def device_line(r):
+    if r.device:
+        d = r.device
+        return "%s (%s)" % (d.owner.name if d.owner else "N/A", d.name or "N/A")
+    return "<code>%s</code>" % r.mac_addr
+
+
+def render_last1h(rows, as_of):
+    msg_text = "Active in the last hour devices list\nAs of %s\n" % as_of.strftime("%Y.%m.%d %X")
+
+    for k, g in groupby(rows, lambda x: x.last_seen):
+        age = int((as_of - k).seconds / 60)
+        msg_text += "\n<b>%s min ago</b>\n" % str(age) if age > 0 else "\n<b>Now</b>\n"
+        for r in g:
+            msg_text += "• %s\n" % device_line(r)
+
+    return msg_text
+
+
+def history_interval(r, as_of):
+    interval = (as_of.date() - r.last_seen.date()).days
+    if interval >= 7:
+        return "Long time ago"
+    elif interval >= 2:
+        return "Last week"
+    elif interval >= 1:
+        return "Yesterday"
+    else:
+        return "Today"
+
+
+def render_history(rows, as_of):
+    msg_text = "Recent active devices list\nAs of %s\n" % as_of.strftime("%Y.%m.%d %X")
+
+    for k, g in groupby(rows, lambda x: history_interval(x, as_of)):
+        msg_text += "\n<b>%s</b>\n" % k
+        for r in g:
+            msg_text += "%s: %s\n" % (format_datetime(r.last_seen), device_line(r))
+
+    return msg_text
+
+
+# name -> (how far back the report goes, render function)
+REPORTS = {
+    "last1h": (timedelta(hours=1), render_last1h),
+    "history": (None, render_history),
+}
+
+
+def show_report(chat, report, as_of, page_no=1, cursor=None, backward=False, message_id=None):
+    # Sends the page of a report as it is at as_of, or replaces the page shown in message_id
+    period, render = REPORTS[report]
+    since = as_of - period if period is not None else None
+    rows, more = fetch_report_page(since, cursor, backward)
+    if backward and (not more or page_no == 1):
+        # Back at the first page, which may have grown with the devices seen again meanwhile
+        page_no, cursor, backward = 1, None, False
+        rows, more = fetch_report_page(since)
+
+    if not rows and page_no == 1:
+        text = render(rows, as_of) + "\nNo devices"
+    else:
+        text = render(rows, as_of)
+        if page_no > 1 or more:
+            text += "\nPage %d" % page_no
+
+    setup = {
+        "report": report,
+        "page_no": page_no,
+        "first": [rows[0].last_seen.isoformat(), rows[0].mac_addr] if rows else None,
+        "last": [rows[-1].last_seen.isoformat(), rows[-1].mac_addr] if rows else None,
+        "has_newer": page_no > 1,
+        "has_older": more if not backward else True,
+    }
+
+    if message_id is None:
+        chat.inline(text, parse_mode='HTML', markup=ReportKeyboard, setup=setup)
+    else:
+        chat.edit(message_id, text, parse_mode='HTML', markup=ReportKeyboard, setup=setup)
+
+
+class ReportKeyboard(InlineKeyboard):
+    # Pages of a report, only the page shown is queried
+    callbacks = {"page": "page"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.report = None
+        self.page_no = 1
+        self.first = None
+        self.last = None
+        self.has_newer = False
+        self.has_older = False
+
+    def build_markup(self):
+        row = []
+        if self.has_newer:
+            row.append(InlineKeyboardButton(CMD_NEWER, callback_data="page|newer"))
+        if self.has_older:
+            row.append(InlineKeyboardButton(CMD_OLDER, callback_data="page|older"))
+        markup = InlineKeyboardMarkup()
+        if row:
+            markup.row(*row)
+        return markup
+
+    def page(self, query, direction):
+        # Pages are queried as of the click, the cursors only tell where the shown page was
+        as_of = datetime.now()
+        if self.first is None:
+            # The page was empty, start over
+            show_report(self.chat, self.report, as_of, message_id=query.message.message_id)
+        elif direction == "older" and self.has_older:
+            show_report(self.chat, self.report, as_of, self.page_no + 1, self.last,
+                        message_id=query.message.message_id)
+        elif direction == "newer" and self.has_newer:
+            show_report(self.chat, self.report, as_of, self.page_no - 1, self.first, backward=True,
+                        message_id=query.message.message_id)
 
 
 class SearchKeyboard(InlineKeyboard):
@@ -321,62 +459,172 @@ class SearchKeyboard(InlineKeyboard):
     }]
 
 
-def new_device_alert(mac_addr):
+def send_new_devices_alert(mac_addrs):
+    if len(mac_addrs) == 1:
+        text = "New device has been detected!\nMAC address: <code>%s</code>" % mac_addrs[0]
+    else:
+        text = "%d new devices have been detected!\n\n%s" % (
+            len(mac_addrs), "\n".join("<code>%s</code>" % m for m in mac_addrs))
+
     admin_chat = bot.get_or_create_chat(ADMIN_CHAT)
     admin_chat.inline(
-        "New device has been detected!\nMAC address: <code>%s</code>" % mac_addr,
+        text,
         parse_mode='HTML',
-        markup=NewDeviceAlertKeyboard,
-        setup={"mac_addr": mac_addr},
+        markup=NewDevicesKeyboard,
+        setup={"mac_addrs": list(mac_addrs)},
     )
 
 
+def create_scanner(conf, interval):
+    scanner_type = conf['type']
+    if scanner_type == "arping":
+        return ARPScanner(
+            interval, conf["interface"], conf["subnet"],
+            passive=conf.get("passive", False),
+            active_every=conf.get("active_every", None),
+            presence_ttl=conf.get("presence_ttl", None),
+            shard_prefix=conf.get("shard_prefix", None),
+            workers=conf.get("workers", 1),
+            rate=conf.get("rate", None),
+            timeout=conf.get("timeout", 2),
+            retry=conf.get("retry", 1),
+            adaptive=conf.get("adaptive", False),
+            full_sweep_every=conf.get("full_sweep_every", 10),
+            max_backoff=conf.get("max_backoff", 4),
+        )
+    elif scanner_type == "routeros_api":
+        use_ssl = conf.get("use_ssl", True)
+        ssl_context = None
+        if use_ssl:
+            ssl_context = ssl.create_default_context()
+            ssl_context.load_verify_locations(conf["cert_file"])
+            ssl_context.check_hostname = False
+
+        # The subnets option is merged into the filters, see scanner_filter()
+        return RouterOsScanner(
+            interval, conf['address'], conf["username"], conf["password"], ssl_context,
+            port=conf.get("port", None),
+            use_ssl=use_ssl,
+            streaming=conf.get("streaming", False),
+            failure_threshold=conf.get("failure_threshold", 3),
+            backoff_cap=conf.get("backoff_cap", 300),
+        )
+    else:
+        raise ValueError("Unknown scanner type. Should be one of ['arping', 'routeros_api']")
+
+
+def scanner_filter(conf):
+    # The filters section, with the older subnets option of routeros_api scanners as its include CIDRs
+    settings = dict(conf.get("filters") or {})
+    subnets = conf.get("subnets", None)
+    if subnets:
+        if settings.get("include"):
+            raise ValueError("Scanner options subnets and filters.include can't be used together, "
+                             "move the subnets to filters.include")
+        settings["include"] = subnets
+    return HostFilter.from_settings(settings)
+
+
 if __name__ == "__main__":
 
     with open(os.path.join(os.path.dirname(__file__), 'lanwatcher.yml')) as f:
         settings = yaml.safe_load(f.read())
         TOKEN = settings["bot_token"]
         ADMIN_CHAT = settings["admin_chat"]
+        BOT_WORKERS = settings.get("bot_workers", 4)
+        BOT_MAX_PENDING = settings.get("bot_max_pending", 100)
+        BOT_HANDLER_TIMEOUT = settings.get("bot_handler_timeout", 60)
+        # "threaded" (telebot long polling) or "asyncio", only the latter supports bot_api_url and bot_webhook
+        BOT_TRANSPORT = settings.get("bot_transport", "threaded")
+        BOT_API_URL = settings.get("bot_api_url", None)
+        BOT_WEBHOOK = settings.get("bot_webhook", None)
+        # Chats and inline keyboards kept in memory, the rest are loaded from the database when needed
+        BOT_MAX_CHATS = settings.get("bot_max_chats", 1000)
+        BOT_MAX_KEYBOARDS = settings.get("bot_max_keyboards", 100)
+        BOT_CHAT_DAYS = settings.get("bot_chat_days", None)
+        BOT_KEYBOARD_DAYS = settings.get("bot_keyboard_days", 30)
         INTERVAL = settings["scan_interval"]
-        SCANNER = settings["scanner"]
-
-    scanner_type = SCANNER['type']
-    if scanner_type == "arping":
-        scanner = ARPScanner(INTERVAL, SCANNER["interface"], SCANNER["subnet"])
-    elif scanner_type == "routeros_api":
-        ssl_context = ssl.create_default_context()
-        ssl_context.load_verify_locations(SCANNER["cert_file"])
-        ssl_context.check_hostname = False
-
-        subnet_filters = SCANNER.get("subnets", None)
-
-        scanner = RouterOsScanner(
-            INTERVAL, SCANNER['address'], SCANNER["username"], SCANNER["password"], ssl_context, subnet_filters
-        )
+        SCAN_OVERRUN = settings.get("scan_overrun", "skip")
+        SCAN_JITTER = settings.get("scan_jitter", 0)
+        # Either a single scanner or a list of scanners to be run concurrently
+        SCANNERS = settings["scanners"] if "scanners" in settings else [settings["scanner"]]
+        SCAN_TIMEOUT = settings.get("scan_timeout", None)
+        RETENTION = settings.get("retention", {})
+        # window, max_batch, rate, per, min_interval of AlertDispatcher
+        ALERTS = settings.get("alerts", {})
+
+    migrate()
+    writer.start()
+    people.load(Person.select(Person.id, Person.name).tuples())
+
+    scanners = []
+    for conf in SCANNERS:
+        s = create_scanner(conf, INTERVAL)
+        host_filter = scanner_filter(conf)
+        if host_filter is not None:
+            s.set_filter(host_filter)
+        scanners.append(s)
+    if len(scanners) == 1:
+        scanner = scanners[0]
     else:
-        raise ValueError("Unknown scanner type. Should be one of ['arping', 'routeros_api']")
-
-    scanner.set_new_device_alert(new_device_alert)
-
-    bot = TelegramBot(TOKEN, BotMainState)
+        scanner = ScannerGroup(INTERVAL, scanners, timeout=SCAN_TIMEOUT)
+
+    alerts = AlertDispatcher(send_new_devices_alert, **ALERTS)
+    scanner.set_new_device_alert(alerts.notify)
+    scanner.set_schedule(overrun=SCAN_OVERRUN, jitter=SCAN_JITTER)
+
+    bot_options = {
+        "workers": BOT_WORKERS,
+        "max_pending": BOT_MAX_PENDING,
+        "handler_timeout": BOT_HANDLER_TIMEOUT,
+        "store": SqliteStateStore(chat_days=BOT_CHAT_DAYS, keyboard_days=BOT_KEYBOARD_DAYS),
+        "max_chats": BOT_MAX_CHATS,
+        "max_keyboards": BOT_MAX_KEYBOARDS,
+        "keyboard_ttl": 24 * 3600,
+    }
+    if BOT_TRANSPORT == "asyncio":
+        webhook = BOT_WEBHOOK or {}
+        bot = AsyncTelegramBot(TOKEN, BotMainState, api_url=BOT_API_URL,
+                               webhook_url=webhook.get("url", None),
+                               webhook_listen=webhook.get("listen", "0.0.0.0"),
+                               webhook_port=webhook.get("port", 8443),
+                               webhook_secret=webhook.get("secret", None),
+                               **bot_options)
+    else:
+        bot = TelegramBot(TOKEN, BotMainState, **bot_options)
     bot.allow_chat(ADMIN_CHAT)
 
     print("Starting bot...")
     bot.start()
     print("Bot started")
+    alerts.start()
 
     print("Starting scanner...")
     scanner.start()
     print("Scanner started")
 
+    retention_job = RetentionJob.from_settings(RETENTION)
+    retention_job.start()
+
     try:
         while True:
             sleep(300)
+            stats = writer.stats()
+            if stats["commits"]:
+                print("Database writer: queue %(queue_depth)d (max %(max_queue_depth)d), %(commits)d commits, "
+                      "%(jobs_per_commit).1f jobs per commit, latency avg %(avg_commit_latency).3f s, "
+                      "max %(max_commit_latency).3f s" % stats)
     except KeyboardInterrupt as e:
         print("Interrupted")
+        print("Stop alerts")
+        alerts.stop()
         print("Stop bot")
         bot.stop()
         print("Stop scanner")
         scanner.stop()
+        print("Stop retention job")
+        retention_job.stop()
+        print("Stop database writer")
+        writer.stop()
         print("Exit")
         sys.exit(e)
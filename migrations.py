@@ -0,0 +1,128 @@
+from datetime import datetime
+from peewee import chunked, fn
+from playhouse.migrate import SqliteMigrator, migrate as apply_operations
+
+from models import db, Person, Device, ScanResult, Presence, DeviceLastSeen, ChatState, KeyboardState, \
+    BATCH_SIZE
+from partitions import partitions, next_month
+
+# The number of applied migrations is kept in SQLite's user_version pragma. New migrations
+# are appended to MIGRATIONS and must never be reordered or removed.
+
+
+def create_base_tables():
+    db.create_tables([Person, Device, ScanResult, Presence])
+
+
+def add_presence_resolution():
+    columns = {c.name for c in db.get_columns(Presence._meta.table_name)}
+    if 'resolution' not in columns:
+        apply_operations(SqliteMigrator(db).add_column(Presence._meta.table_name, 'resolution', Presence.resolution))
+
+
+def compact_scan_results():
+    # Turns per-scan ScanResult rows into Presence intervals
+    if not ScanResult.select().exists():
+        return
+
+    scan_times = [t for (t,) in ScanResult.select(ScanResult.time).distinct().order_by(ScanResult.time).tuples()]
+    scan_index = {t: i for i, t in enumerate(scan_times)}
+
+    rows = ScanResult\
+        .select(ScanResult.mac_addr, ScanResult.ip_addr, ScanResult.device, ScanResult.time)\
+        .order_by(ScanResult.mac_addr, ScanResult.ip_addr, ScanResult.time)\
+        .tuples()\
+        .iterator()
+
+    intervals = []
+    current = None
+    for mac_addr, ip_addr, device, time in rows:
+        if current is not None \
+                and current["mac_addr"] == mac_addr and current["ip_addr"] == ip_addr \
+                and scan_index[time] - scan_index[current["last_seen"]] <= 1:
+            current["last_seen"] = time
+            current["device"] = current["device"] or device
+            continue
+
+        current = {
+            "mac_addr": mac_addr,
+            "ip_addr": ip_addr,
+            "device": device,
+            "first_seen": time,
+            "last_seen": time,
+        }
+        intervals.append(current)
+
+    for batch in chunked(intervals, BATCH_SIZE):
+        Presence.insert_many(batch).execute()
+    ScanResult.delete().execute()
+
+    print("Scan history compacted into %d presence intervals" % len(intervals))
+
+
+def add_history_indexes():
+    Presence._schema.create_indexes(safe=True)
+
+
+def create_device_last_seen():
+    db.create_tables([DeviceLastSeen])
+
+    latest = Presence\
+        .select(Presence.mac_addr, Presence.ip_addr, Presence.last_seen)\
+        .group_by(Presence.mac_addr)\
+        .having(Presence.last_seen == fn.Max(Presence.last_seen))
+    DeviceLastSeen.insert_from(latest, [DeviceLastSeen.mac_addr, DeviceLastSeen.ip_addr, DeviceLastSeen.last_seen])\
+        .on_conflict_ignore()\
+        .execute()
+
+
+def partition_presence():
+    # Moves the intervals into monthly partitions, an interval crossing a month boundary stays
+    # whole in the month it started
+    months = [datetime(y, m, 1) for y, m in Presence
+              .select(fn.strftime('%Y', Presence.first_seen).cast('INTEGER'),
+                      fn.strftime('%m', Presence.first_seen).cast('INTEGER'))
+              .distinct()
+              .tuples()]
+    fields = [f for f in Presence._meta.sorted_fields if f is not Presence.id]
+
+    for month in months:
+        model = partitions.get(month, create=True)
+        rows = Presence\
+            .select(*fields)\
+            .where((Presence.first_seen >= month) & (Presence.first_seen < next_month(month)))\
+            .order_by(Presence.first_seen)
+        model.insert_from(rows, [getattr(model, f.name) for f in fields]).execute()
+    Presence.delete().execute()
+
+    print("Presence history split into %d monthly partitions" % len(months))
+
+
+def create_bot_state():
+    db.create_tables([ChatState, KeyboardState])
+
+
+def add_report_index():
+    DeviceLastSeen._schema.create_indexes(safe=True)
+
+
+MIGRATIONS = [
+    create_base_tables,
+    add_presence_resolution,
+    compact_scan_results,
+    add_history_indexes,
+    create_device_last_seen,
+    partition_presence,
+    create_bot_state,
+    add_report_index,
+]
+
+
+def migrate():
+    version = db.pragma('user_version')
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print("Applying migration %d: %s" % (number, migration.__name__))
+        with db.atomic():
+            migration()
+            db.pragma('user_version', number)
+    return len(MIGRATIONS) - version
@@ -1,6 +1,16 @@
 from peewee import *
 
-db = SqliteDatabase('lan.db')
+# WAL lets the bot read while a scan is being written. Every thread gets its own connection,
+# writes are serialized by writer.DatabaseWriter.
+db = SqliteDatabase('lan.db', timeout=10, pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -16 * 1024,
+    'temp_store': 'memory',
+})
+
+# Rows per multi-row statement, keeps the number of bound parameters below SQLite's limit
+BATCH_SIZE = 100
 
 
 class BaseModel(Model):
@@ -28,5 +38,51 @@ class ScanResult(BaseModel):
     ip_addr = TextField()
 
 
-def create_tables():
-    return db.create_tables([Person, Device, ScanResult])
+class Presence(BaseModel):
+    # A host seen with the same address in consecutive scans from first_seen to last_seen
+    mac_addr = TextField()
+    ip_addr = TextField()
+    # No longer filled in, the device is looked up by mac_addr when history is read
+    device = ForeignKeyField(Device, null=True)
+    first_seen = DateTimeField()
+    last_seen = DateTimeField(index=True)
+    # Granularity of the interval in seconds, 0 for raw scan results and greater for rollups
+    resolution = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('mac_addr', 'last_seen'), False),
+        )
+
+
+class DeviceLastSeen(BaseModel):
+    # The latest sighting of every MAC address, updated on each scan
+    mac_addr = TextField(unique=True)
+    ip_addr = TextField()
+    last_seen = DateTimeField(index=True)
+
+    class Meta:
+        # Keyset pagination of the reports
+        indexes = (
+            (('last_seen', 'mac_addr'), False),
+        )
+
+
+class ChatState(BaseModel):
+    # Serialized ChatFSM state of a bot chat
+    chat_id = BigIntegerField(unique=True)
+    data = TextField()
+    updated = DateTimeField(index=True)
+
+
+class KeyboardState(BaseModel):
+    # Serialized inline keyboard of a sent message
+    chat_id = BigIntegerField()
+    message_id = IntegerField()
+    data = TextField()
+    updated = DateTimeField(index=True)
+
+    class Meta:
+        indexes = (
+            (('chat_id', 'message_id'), True),
+        )
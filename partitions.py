@@ -0,0 +1,117 @@
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+from models import db, Presence
+from writer import writer
+
+# Presence intervals are stored in one table per month, named presence_YYYY_MM. An interval belongs
+# to the month of its first_seen and never crosses into the next one: the scanner starts new
+# intervals in the new month's table. Queries bounded in time only read the months they overlap,
+# and old months are dropped or archived as whole tables instead of being deleted row by row.
+
+PARTITION_NAME = re.compile(r"^presence_(\d{4})_(\d{2})$")
+
+
+def month_start(dt):
+    return datetime(dt.year, dt.month, 1)
+
+
+def next_month(dt):
+    return datetime(dt.year + 1, 1, 1) if dt.month == 12 else datetime(dt.year, dt.month + 1, 1)
+
+
+def partition_name(month):
+    return "presence_%04d_%02d" % (month.year, month.month)
+
+
+def partition_model(month):
+    name = partition_name(month)
+    meta = type("Meta", (), {"table_name": name})
+    return type(name.title().replace("_", ""), (Presence,), {"Meta": meta, "__module__": __name__})
+
+
+class PresencePartitions:
+    def __init__(self, database):
+        self.db = database
+        # month -> model of the partition table, only for tables that exist
+        self._models = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not self._loaded:
+            for table in self.db.get_tables():
+                match = PARTITION_NAME.match(table)
+                if match:
+                    month = datetime(int(match.group(1)), int(match.group(2)), 1)
+                    self._models.setdefault(month, partition_model(month))
+            self._loaded = True
+
+    def reload(self):
+        # Forgets the partitions found so far, for when the database has been switched
+        with self._lock:
+            self._models = {}
+            self._loaded = False
+
+    def months(self):
+        with self._lock:
+            self._load()
+            return sorted(self._models)
+
+    def get(self, dt, create=False):
+        # The partition holding intervals that start at dt, None if it doesn't exist and create is False
+        month = month_start(dt)
+        with self._lock:
+            self._load()
+            model = self._models.get(month)
+            if model is None and create:
+                # Created under the lock so that two threads never create the same month. Writer jobs
+                # don't use partitions, so waiting for the writer here can't deadlock.
+                model = partition_model(month)
+                writer.run(model.create_table)
+                self._models[month] = model
+        return model
+
+    def between(self, start=None, end=None):
+        # Partitions that may hold intervals overlapping [start, end], oldest first
+        with self._lock:
+            self._load()
+            return [model for month, model in sorted(self._models.items())
+                    if (start is None or next_month(month) >= start) and (end is None or month <= end)]
+
+    def drop(self, month):
+        with self._lock:
+            self._load()
+            model = self._models.pop(month, None)
+            if model is not None:
+                writer.run(model.drop_table)
+
+    def archive(self, month, directory):
+        # Copies the partition into its own SQLite file and drops it from the database.
+        # The copy reads a WAL snapshot of the database, so scans keep writing in the meantime.
+        model = self.get(month)
+        if model is None:
+            return None
+
+        name = partition_name(month)
+        path = os.path.join(directory, "%s.db" % name)
+        os.makedirs(directory, exist_ok=True)
+        archive = sqlite3.connect(path)
+        try:
+            archive.execute("ATTACH DATABASE ? AS lan", (self.db.database,))
+            with archive:
+                # Unqualified names would fall back to the attached database
+                archive.execute('DROP TABLE IF EXISTS main."%s"' % name)
+                archive.execute('CREATE TABLE main."%s" AS SELECT * FROM lan."%s"' % (name, name))
+            archive.execute("DETACH DATABASE lan")
+        finally:
+            archive.close()
+
+        self.drop(month)
+        return path
+
+
+partitions = PresencePartitions(db)
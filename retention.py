@@ -0,0 +1,176 @@
+import threading
+from datetime import datetime, timedelta
+
+from models import BATCH_SIZE
+from writer import writer
+from partitions import partitions, next_month
+from peewee import chunked
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+_EPOCH = datetime(2000, 1, 1)
+
+
+def floor_time(dt, resolution):
+    return dt - timedelta(seconds=(dt - _EPOCH).total_seconds() % resolution)
+
+
+def ceil_time(dt, resolution):
+    floor = floor_time(dt, resolution)
+    return floor if floor == dt else floor + timedelta(seconds=resolution)
+
+
+def merge_intervals(rows, resolution):
+    # rows should be sorted by first_seen and belong to the same MAC address
+    merged = []
+    for r in rows:
+        first_seen = floor_time(r.first_seen, resolution)
+        last_seen = ceil_time(r.last_seen, resolution)
+
+        if merged and first_seen <= merged[-1]["last_seen"]:
+            m = merged[-1]
+            if last_seen >= m["last_seen"]:
+                m["last_seen"] = last_seen
+                m["ip_addr"] = r.ip_addr
+            continue
+
+        merged.append({
+            "mac_addr": r.mac_addr,
+            "ip_addr": r.ip_addr,
+            "first_seen": first_seen,
+            "last_seen": last_seen,
+            "resolution": resolution,
+        })
+
+    return merged
+
+
+class RetentionJob:
+    # Settings (all optional) from the `retention` section of lanwatcher.yml:
+    #   raw_days: 7         keep full resolution presence intervals for this many days
+    #   hourly_days: 365    then keep them rolled up to hours, and rolled up to days after that
+    #   daily_days: null    delete daily rollups older than this, keep forever if not set
+    #   archive_dir: null   months older than daily_days are moved to SQLite files in this directory
+    #                       instead of being deleted
+    #   interval: 3600      seconds between compaction runs
+    #   chunk_size: 500     rows processed per transaction
+
+    def __init__(self, raw_days=7, hourly_days=365, daily_days=None, archive_dir=None, interval=HOUR,
+                 chunk_size=500):
+        self.raw_days = raw_days
+        self.hourly_days = hourly_days
+        self.daily_days = daily_days
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.chunk_size = chunk_size
+
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(**(settings or {}))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run()
+            except Exception as e:
+                print("Retention job failed: %r" % e)
+            self._stop.wait(self.interval)
+
+    def run(self, now=None):
+        now = now or datetime.now()
+
+        if self.raw_days is not None:
+            self.rollup(HOUR, now - timedelta(days=self.raw_days))
+        if self.hourly_days is not None:
+            self.rollup(DAY, now - timedelta(days=self.hourly_days))
+        if self.daily_days is not None:
+            self.purge(now - timedelta(days=self.daily_days))
+
+    def rollup(self, resolution, cutoff):
+        total = 0
+        for model in partitions.between(end=cutoff):
+            while not self._stop.is_set():
+                count = writer.run(self._rollup_chunk, model, resolution, cutoff)
+                if count == 0:
+                    break
+                total += count
+        return total
+
+    def _rollup_chunk(self, model, resolution, cutoff):
+        rows = list(model
+                    .select()
+                    .where((model.resolution < resolution) & (model.last_seen < cutoff))
+                    .order_by(model.mac_addr, model.first_seen)
+                    .limit(self.chunk_size))
+        if not rows:
+            return 0
+
+        by_mac = {}
+        for r in rows:
+            by_mac.setdefault(r.mac_addr, []).append(r)
+
+        # Rollups made by previous runs are merged with the new ones
+        earliest = floor_time(min(r.first_seen for r in rows), resolution)
+        previous = model\
+            .select()\
+            .where((model.resolution == resolution) &
+                   (model.mac_addr.in_(list(by_mac))) &
+                   (model.last_seen >= earliest))
+        for r in previous:
+            by_mac[r.mac_addr].append(r)
+
+        merged = []
+        ids = []
+        for mac_rows in by_mac.values():
+            mac_rows.sort(key=lambda x: x.first_seen)
+            merged.extend(merge_intervals(mac_rows, resolution))
+            ids.extend(r.id for r in mac_rows)
+
+        for batch in chunked(ids, BATCH_SIZE):
+            model.delete().where(model.id.in_(batch)).execute()
+        for batch in chunked(merged, BATCH_SIZE):
+            model.insert_many(batch).execute()
+
+        return len(rows)
+
+    def purge(self, cutoff):
+        # Months that ended before the cutoff go away as whole tables, the month containing it
+        # is cleaned up in chunks
+        total = 0
+        for month in partitions.months():
+            if self._stop.is_set():
+                break
+            if next_month(month) <= cutoff:
+                if self.archive_dir is not None:
+                    path = partitions.archive(month, self.archive_dir)
+                    print("Presence history of %s archived to %s" % (month.strftime("%Y-%m"), path))
+                else:
+                    partitions.drop(month)
+                    print("Presence history of %s deleted" % month.strftime("%Y-%m"))
+            elif month < cutoff:
+                model = partitions.get(month)
+                while not self._stop.is_set():
+                    count = writer.run(self._purge_chunk, model, cutoff)
+                    if count == 0:
+                        break
+                    total += count
+        return total
+
+    def _purge_chunk(self, model, cutoff):
+        ids = model\
+            .select(model.id)\
+            .where(model.last_seen < cutoff)\
+            .limit(self.chunk_size)
+        return model.delete().where(model.id.in_(ids)).execute()
@@ -1,55 +1,302 @@
+import random
+import socket
+import threading
+import time
 import routeros_api
 import routeros_api.exceptions
-from datetime import datetime
-from ipaddress import ip_address, ip_network
 
-from scanner import AbstractScanner
+from scanner import AbstractScanner, ScannerUnavailable
+from filters import HostFilter
+
+ARP_PROPERTIES = "address,mac-address,interface"
+
+CONNECTION_ERRORS = (
+    routeros_api.exceptions.RouterOsApiConnectionError,
+    routeros_api.exceptions.FatalRouterOsApiError,
+    routeros_api.exceptions.RouterOsApiFatalCommunicationError,
+    OSError,
+)
+
+
+class Backoff:
+    # Exponential backoff with full jitter
+    def __init__(self, base=1, cap=300):
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        return random.uniform(0, min(self.cap, self.base * 2 ** (self.failures - 1)))
+
+    def reset(self):
+        self.failures = 0
+
+
+class TLSSessionCache:
+    # Wraps an SSLContext so that new connections resume the previous TLS session
+    def __init__(self, context):
+        self.context = context
+        self.session = None
+        self.resumed = 0
+
+    def wrap_socket(self, sock, server_hostname=None, **kwargs):
+        ssl_sock = self.context.wrap_socket(sock, server_hostname=server_hostname, session=self.session, **kwargs)
+        if ssl_sock.session_reused:
+            self.resumed += 1
+        return ssl_sock
+
+    def remember(self, pool):
+        session = getattr(pool.socket.socket, "session", None)
+        if session is not None:
+            self.session = session
+
+
+class RouterConnection:
+    # One API connection to a router with a circuit breaker. Connection errors are retried at once
+    # until failure_threshold errors in a row, then the circuit opens and calls fail immediately
+    # until the backoff delay passes. The next call is a trial: on success the circuit closes,
+    # on failure it opens again with a longer delay.
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, name, create_pool, tls=None, failure_threshold=3, backoff_base=1, backoff_cap=300):
+        self.name = name
+        self._create_pool = create_pool
+        self.tls = tls
+        self.failure_threshold = failure_threshold
+        self.backoff = Backoff(backoff_base, backoff_cap)
+
+        self.pool = None
+        self.api = None
+        self.state = self.CLOSED
+        self.retry_at = 0
+        self._lock = threading.Lock()
+
+        self.connects = 0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_success = None
+        self.last_latency = None
+
+    def _connect(self):
+        self.pool = self._create_pool()
+        self.api = self.pool.get_api()
+        self.connects += 1
+        if self.tls is not None:
+            self.tls.remember(self.pool)
+
+    def disconnect(self):
+        if self.pool is not None:
+            self.pool.disconnect()
+        self.pool = None
+        self.api = None
+
+    def call(self, fn):
+        # fn receives RouterOsApi and makes the requests
+        with self._lock:
+            while True:
+                if self.state == self.OPEN:
+                    if time.monotonic() < self.retry_at:
+                        raise ScannerUnavailable("Router %s is unavailable, next attempt in %.0f s (%r)" %
+                                                 (self.name, self.retry_at - time.monotonic(), self.last_error))
+                    self.state = self.HALF_OPEN
+
+                try:
+                    if self.api is None:
+                        self._connect()
+                    start = time.monotonic()
+                    result = fn(self.api)
+                    self.last_latency = time.monotonic() - start
+                except CONNECTION_ERRORS as e:
+                    self._failed(e)
+                    continue
+
+                self.calls += 1
+                self.consecutive_failures = 0
+                self.backoff.reset()
+                self.state = self.CLOSED
+                self.last_success = time.time()
+                return result
+
+    def _failed(self, error):
+        self.disconnect()
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_error = error
+
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.retry_at = time.monotonic() + self.backoff.failure()
+
+    def health(self):
+        return {
+            "state": self.state,
+            "connected": self.api is not None,
+            "connects": self.connects,
+            "calls": self.calls,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": repr(self.last_error) if self.last_error else None,
+            "last_success": self.last_success,
+            "last_latency": self.last_latency,
+            "tls_sessions_resumed": self.tls.resumed if self.tls is not None else None,
+        }
+
+
+class ArpTableMirror:
+    # Keeps a local copy of the router's ARP table. The table is fetched once, then kept up to date
+    # with the changes the router sends over a dedicated `listen` connection.
+    # routeros_api keeps every row of a response until the command is done, and `listen` never is:
+    # after max_changes changes the listen is issued again on a new connection and the table fetched
+    # again, which bounds the memory. Scans keep reading the old copy in the meantime.
+
+    def __init__(self, connect, backoff=None, max_changes=10000):
+        # connect should return a new RouterOsApiPool
+        self._connect = connect
+        self.backoff = backoff or Backoff()
+        self.max_changes = max_changes
+
+        self.entries = {}
+        self.synced = False
+        self.resyncs = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = None
+        self.thread = threading.Thread(target=self._loop, name="routeros-listen", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        pool = self._pool
+        if pool is not None:
+            # Wakes up the thread blocked on reading from the socket
+            try:
+                pool.socket.socket.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+        self.thread.join()
+
+    def hosts(self):
+        with self._lock:
+            return [(e["mac-address"], e["address"], e.get("interface")) for e in self.entries.values()
+                    if e.get("complete", "true") == "true" and "mac-address" in e]
+
+    def apply(self, row):
+        with self._lock:
+            if row.get(".dead") == "true":
+                self.entries.pop(row["id"], None)
+            else:
+                self.entries.setdefault(row["id"], {}).update(row)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+                failed = False
+            except Exception as e:
+                failed = True
+                if not self._stop.is_set():
+                    print("RouterOS listen connection failed: %r" % e)
+            if self._pool is not None:
+                self._pool.disconnect()
+                self._pool = None
+            if failed:
+                self.synced = False
+                self._stop.wait(self.backoff.failure())
+            else:
+                self.resyncs += 1
+
+    def _listen(self):
+        # Returns after max_changes changes, raises if the connection fails
+        self._pool = self._connect()
+        api = self._pool.get_api()
+        # Changes may be rare, so the connection should never time out while waiting for them
+        self._pool.set_timeout(None)
+
+        resource = api.get_resource('/ip/arp')
+        # Changes made while the table is being fetched are received afterwards
+        changes = resource.call_async('listen')
+        table = resource.call('print', {'proplist': ".id,complete," + ARP_PROPERTIES})
+
+        with self._lock:
+            self.entries = {row["id"]: row for row in table}
+        self.synced = True
+        self.backoff.reset()
+
+        count = 0
+        for row in changes:
+            if self._stop.is_set():
+                break
+            self.apply(row)
+            count += 1
+            if count >= self.max_changes:
+                return
+        if not self._stop.is_set():
+            raise routeros_api.exceptions.RouterOsApiConnectionError("The router has ended the listen command")
 
 
 class RouterOsScanner(AbstractScanner):
-    def __init__(self, interval, address, username, password, ssl_context=None, subnet_filters=None):
+    # In streaming mode the ARP table is mirrored with ArpTableMirror, and scans read the mirror
+    # instead of fetching the table from the router.
+
+    def __init__(self, interval, address, username, password, ssl_context=None, subnet_filters=None,
+                 port=None, use_ssl=True, streaming=False, failure_threshold=3, backoff_cap=300):
         super().__init__(interval)
 
-        self.api = None
         self._address = address
         self._username = username
         self._password = password
-        self._ssl_context = ssl_context
-        self.connect_api()
+        self._port = port
+        self._use_ssl = use_ssl
+        self._tls = TLSSessionCache(ssl_context) if use_ssl and ssl_context is not None else None
+        self.connection = RouterConnection(address, self.create_pool, self._tls, failure_threshold,
+                                           backoff_cap=backoff_cap)
+
+        if subnet_filters:
+            self.set_filter(HostFilter(include=subnet_filters))
 
-        if not subnet_filters:
-            self.subnet_filters = None
-        else:
-            self.subnet_filters = [ip_network(sf) for sf in subnet_filters]
+        self.mirror = ArpTableMirror(self.create_pool, Backoff(cap=backoff_cap)) if streaming else None
 
-    def connect_api(self):
-        connection = routeros_api.RouterOsApiPool(
+    def create_pool(self):
+        return routeros_api.RouterOsApiPool(
             host=self._address,
             username=self._username,
             password=self._password,
-            use_ssl=True,
-            ssl_context=self._ssl_context,
+            port=self._port,
+            use_ssl=self._use_ssl,
+            ssl_context=self._tls,
             plaintext_login=True,
         )
-        self.api = connection.get_api()
+
+    def fetch_hosts(self):
+        hosts = self.connection.call(
+            lambda api: api.get_resource('/ip/arp').call('print', {'proplist': ARP_PROPERTIES}, {'complete': 'true'})
+        )
+        return [(host['mac-address'], host['address'], host.get('interface')) for host in hosts]
+
+    def health(self):
+        health = self.connection.health()
+        if self.mirror is not None:
+            health["mirror_synced"] = self.mirror.synced
+        return health
 
     def scan(self):
-        if self.api is None:
-            self.connect_api()
+        if self.mirror is not None:
+            if self.mirror.thread.ident is None:
+                self.mirror.start()
+            return self.mirror.hosts() if self.mirror.synced else self.fetch_hosts()
 
-        for attempt in range(3):
-            try:
-                hosts = self.api.get_resource('/ip/arp').get(complete='true')
-                break
-            except routeros_api.exceptions.RouterOsApiConnectionError:
-                self.connect_api()
-        else:
-            raise RuntimeError("Can't use established api connection")
-
-        self.last_scan = timestamp = datetime.now()
-        for host in hosts:
-            if self.subnet_filters:
-                addr = ip_address(host['address'])
-                if not any(addr in subnet for subnet in self.subnet_filters):
-                    continue
-            self.add_scan_result(host['mac-address'], host['address'], timestamp)
+        return self.fetch_hosts()
+
+    def stop(self):
+        super().stop()
+        if self.mirror is not None and self.mirror.thread.ident is not None:
+            self.mirror.stop()
+        self.connection.disconnect()
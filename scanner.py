@@ -1,57 +1,291 @@
 import threading
-from models import Device, ScanResult
-from itertools import chain
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from models import Person, Device, DeviceLastSeen, BATCH_SIZE
+from writer import writer
+from partitions import partitions, month_start
+from peewee import chunked, Tuple, JOIN, EXCLUDED
 from datetime import datetime
+from scheduler import Scheduler, OVERRUN_SKIP
+
+
+# Hosts found by the last scan, published as a whole after each cycle and never modified
+Snapshot = namedtuple("Snapshot", ["time", "hosts"])
+HostSnapshot = namedtuple("HostSnapshot", ["mac_addr", "ip_addr", "registered", "device", "owner"])
+
+
+class ScannerUnavailable(RuntimeError):
+    # Raised by scan() when results can't be obtained right now, the cycle is skipped then
+    pass
+
+
+def normalize_mac(mac_addr):
+    return mac_addr.lower().replace("-", ":")
 
 
 class AbstractScanner:
     def __init__(self, interval):
         self.last_scan = None
+        self.snapshot = None
+        self._snapshot_lock = threading.Lock()
         self.new_device_alert = None
-        self.known_devices = []
-        self._registered_devices = []
+        self.known_devices = set()
+        self._registered_devices = {}
+        # (mac_addr, ip_addr) -> last_seen of the pair's open Presence interval
+        self._present = {}
+
+        self.host_filter = None
 
         self.scan_interval = interval
+        self.overrun_policy = OVERRUN_SKIP
+        self.scan_jitter = 0
 
-        self.timer = None
+        self.scheduler = None
 
     def scan(self):
+        # Should return an iterable of (mac_addr, ip_addr) or (mac_addr, ip_addr, interface) tuples
         raise NotImplemented
 
-    def cycle_scan(self):
-        self.timer = threading.Timer(self.scan_interval, self.cycle_scan)
-        self.timer.start()
+    def collect(self):
+        hosts = self.scan()
+        if self.host_filter is not None:
+            hosts = self.host_filter.apply(hosts)
+        return hosts
 
-        self._registered_devices = [d for d in Device.select()]
-        self.scan()
+    def cycle_scan(self):
+        try:
+            hosts = self.collect()
+        except ScannerUnavailable as e:
+            print("Scan skipped: %s" % e)
+            return
+        self.save_scan_results(hosts, datetime.now())
 
     def start(self):
-        results = ScanResult.select(ScanResult.mac_addr).distinct()
-        devices = Device.select(Device.mac_addr).distinct()
-        for r in chain(results, devices):
-            if r.mac_addr not in self.known_devices:
-                self.known_devices.append(r.mac_addr)
-
-        self.cycle_scan()
-
-    def add_scan_result(self, mac_addr_raw, ip_addr, timestamp=None):
-        mac_addr = mac_addr_raw.lower().replace("-", ":")
-        device = None
-        for d in self._registered_devices:
-            if d.mac_addr == mac_addr:
-                device = d
-                break
-
-        ScanResult(time=(timestamp or datetime.now()), device=device, mac_addr=mac_addr, ip_addr=ip_addr).save()
-
-        if mac_addr not in self.known_devices:
-            self.known_devices.append(mac_addr)
+        devices = Device.select(Device, Person).join(Person, JOIN.LEFT_OUTER)
+        self._registered_devices = {d.mac_addr: d for d in devices}
+
+        self.known_devices.update(r.mac_addr for r in DeviceLastSeen.select(DeviceLastSeen.mac_addr))
+        self.known_devices.update(self._registered_devices)
+
+        self.scheduler = Scheduler(
+            self.scan_interval,
+            self.cycle_scan,
+            overrun=self.overrun_policy,
+            jitter=self.scan_jitter,
+            name=type(self).__name__,
+        )
+        self.scheduler.start()
+
+    def update_device(self, device):
+        # Should be called whenever a Device is added or changed
+        self._registered_devices[device.mac_addr] = device
+        self.known_devices.add(device.mac_addr)
+        self._refresh_snapshot()
+
+    def _make_snapshot(self, timestamp, pairs):
+        hosts = []
+        for mac_addr, ip_addr in pairs:
+            d = self._registered_devices.get(mac_addr)
+            if d is None:
+                hosts.append(HostSnapshot(mac_addr, ip_addr, False, None, None))
+            else:
+                hosts.append(HostSnapshot(mac_addr, ip_addr, True, d.name, d.owner.name if d.owner else None))
+        return Snapshot(timestamp, tuple(hosts))
+
+    def _refresh_snapshot(self):
+        with self._snapshot_lock:
+            if self.snapshot is not None:
+                pairs = [(h.mac_addr, h.ip_addr) for h in self.snapshot.hosts]
+                self.snapshot = self._make_snapshot(self.snapshot.time, pairs)
+
+    def save_scan_results(self, hosts, timestamp, seen=None):
+        # seen maps MAC addresses to the time they were found at, for hosts whose results were obtained
+        # before timestamp (see ScannerGroup). Their intervals are extended only up to that time, and not
+        # at all when it's no later than what is recorded already: reused results keep the intervals open
+        # without moving last_seen.
+        seen = seen or {}
+        partition = partitions.get(timestamp, create=True)
+        month = month_start(timestamp)
+        # Intervals don't cross into the next month's partition, they are started again there
+        if self.last_scan is not None and partitions.get(self.last_scan) is partition:
+            previous = self._present
+        else:
+            previous = {}
+
+        found = set()
+        present_order = []
+        present = {}
+        rows = []
+        # (last_seen now, new last_seen) -> pairs whose interval is extended
+        extended = {}
+        last_seen = {}
+        new_devices = {}
+        for mac_addr_raw, ip_addr, *_ in hosts:
+            mac_addr = normalize_mac(mac_addr_raw)
+            pair = (mac_addr, ip_addr)
+            if pair in found:
+                continue
+            found.add(pair)
+            present_order.append(pair)
+
+            t = seen.get(mac_addr, timestamp)
+            if pair in previous:
+                if t > previous[pair]:
+                    extended.setdefault((previous[pair], t), []).append(pair)
+                    present[pair] = t
+                    last_seen[mac_addr] = {"mac_addr": mac_addr, "ip_addr": ip_addr, "last_seen": t}
+                else:
+                    present[pair] = previous[pair]
+            elif t >= month:
+                rows.append({
+                    "mac_addr": mac_addr,
+                    "ip_addr": ip_addr,
+                    "first_seen": t,
+                    "last_seen": t,
+                })
+                present[pair] = t
+                last_seen[mac_addr] = {"mac_addr": mac_addr, "ip_addr": ip_addr, "last_seen": t}
+            # Otherwise it was found in the previous month and is recorded in that month's partition
+
+            if mac_addr not in self.known_devices:
+                new_devices[mac_addr] = None
+
+        # Hosts that are gone are closed by leaving their intervals as is
+
+        def write():
+            for (old, new), pairs in extended.items():
+                for batch in chunked(pairs, BATCH_SIZE):
+                    partition\
+                        .update(last_seen=new)\
+                        .where((partition.last_seen == old) &
+                               Tuple(partition.mac_addr, partition.ip_addr).in_(batch))\
+                        .execute()
+            for batch in chunked(rows, BATCH_SIZE):
+                partition.insert_many(batch).execute()
+            for batch in chunked(list(last_seen.values()), BATCH_SIZE):
+                # Results of another scanner obtained earlier don't move last_seen back
+                DeviceLastSeen\
+                    .insert_many(batch)\
+                    .on_conflict(conflict_target=[DeviceLastSeen.mac_addr],
+                                 preserve=[DeviceLastSeen.ip_addr, DeviceLastSeen.last_seen],
+                                 where=(EXCLUDED.last_seen > DeviceLastSeen.last_seen))\
+                    .execute()
+
+        writer.run(write)
+
+        self._present = present
+        self.last_scan = timestamp
+        with self._snapshot_lock:
+            self.snapshot = self._make_snapshot(timestamp, present_order)
+
+        # Alerts are sent only after the results have been committed
+        for mac_addr in new_devices:
+            self.known_devices.add(mac_addr)
             if self.new_device_alert is not None:
                 self.new_device_alert(mac_addr)
 
     def set_new_device_alert(self, fn):
         self.new_device_alert = fn
 
+    def set_filter(self, host_filter):
+        self.host_filter = host_filter
+
+    def set_schedule(self, overrun=OVERRUN_SKIP, jitter=0):
+        self.overrun_policy = overrun
+        self.scan_jitter = jitter
+
+    def stop(self):
+        # Waits for the scan in progress to finish
+        if self.scheduler:
+            self.scheduler.stop()
+
+
+class ScannerGroup(AbstractScanner):
+    # Runs several scanners concurrently and ingests their merged results as one cycle.
+    # A scanner that doesn't finish within the timeout keeps running in the background,
+    # its results are merged into the cycle during which it finishes. Until then, and while
+    # a scanner is failing, its previous results are reused for up to max_stale cycles.
+    # Results obtained before the cycle started keep the time they were obtained at, so
+    # late and reused results don't extend intervals past it.
+
+    def __init__(self, interval, scanners, timeout=None, max_stale=3):
+        super().__init__(interval)
+        self.scanners = scanners
+        self.scan_timeout = timeout if timeout is not None else interval / 2
+        self.max_stale = max_stale
+
+        self.pool = ThreadPoolExecutor(max_workers=len(scanners), thread_name_prefix="scanner")
+        self._pending = {}
+        # scanner -> (hosts, time they were obtained at)
+        self._last_results = {}
+        self._stale = {}
+        # MAC address -> time it was found at, for the hosts of the last scan found before it started
+        self._seen = {}
+
+    def cycle_scan(self):
+        hosts = self.collect()
+        self.save_scan_results(hosts, datetime.now(), self._seen)
+
+    def scan(self):
+        started = datetime.now()
+        for s in self.scanners:
+            if s not in self._pending:
+                self._pending[s] = self.pool.submit(self._scan_source, s)
+
+        wait(self._pending.values(), timeout=self.scan_timeout)
+
+        results = []
+        for s in self.scanners:
+            result = self._collect(s)
+            if result is not None:
+                hosts, obtained = result
+                results.append((hosts, obtained if obtained < started else None))
+
+        # The first scanner that reports a MAC address provides all its addresses,
+        # results of this cycle go before the older ones
+        merged = {}
+        self._seen = {}
+        for hosts, obtained in sorted(results, key=lambda r: r[1] is not None):
+            source = {}
+            for mac_addr_raw, ip_addr, *_ in hosts:
+                mac_addr = normalize_mac(mac_addr_raw)
+                if mac_addr not in merged:
+                    source.setdefault(mac_addr, []).append(ip_addr)
+            merged.update(source)
+            if obtained is not None:
+                self._seen.update(dict.fromkeys(source, obtained))
+
+        return [(mac_addr, ip_addr) for mac_addr, addresses in merged.items() for ip_addr in addresses]
+
+    @staticmethod
+    def _scan_source(s):
+        hosts = s.collect()
+        return hosts, datetime.now()
+
+    def _collect(self, s):
+        future = self._pending[s]
+        if future.done():
+            del self._pending[s]
+            try:
+                self._last_results[s] = future.result()
+                self._stale[s] = 0
+                return self._last_results[s]
+            except Exception as e:
+                print("%s failed: %s" % (type(s).__name__, e))
+        else:
+            print("WARNING: %s hasn't finished in %s s, its results are postponed" %
+                  (type(s).__name__, self.scan_timeout))
+
+        if s not in self._last_results:
+            return None
+        self._stale[s] += 1
+        if self._stale[s] > self.max_stale:
+            del self._last_results[s]
+            return None
+        return self._last_results[s]
+
     def stop(self):
-        if self.timer:
-            self.timer.cancel()
+        super().stop()
+        self.pool.shutdown(wait=False)
+        for s in self.scanners:
+            s.stop()
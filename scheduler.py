@@ -0,0 +1,108 @@
+import random
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+
+OVERRUN_SKIP = "skip"
+OVERRUN_DELAY = "delay"
+OVERRUN_COALESCE = "coalesce"
+
+OVERRUN_POLICIES = (OVERRUN_SKIP, OVERRUN_DELAY, OVERRUN_COALESCE)
+
+Tick = namedtuple("Tick", ["scheduled", "started", "duration"])
+
+
+class Scheduler:
+    # Runs fn at a fixed rate in one long-lived thread. Ticks are computed from the start time,
+    # so they don't drift, and a run never overlaps the previous one. When a run takes longer
+    # than the interval, the missed ticks are handled according to the overrun policy:
+    #   skip      wait for the next tick on the original grid
+    #   delay     run immediately and shift the grid to the actual start time
+    #   coalesce  run once immediately for all missed ticks and keep the original grid
+
+    def __init__(self, interval, fn, overrun=OVERRUN_SKIP, jitter=0, name=None, history_size=100):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError("Unknown overrun policy. Should be one of %s" % list(OVERRUN_POLICIES))
+
+        self.interval = interval
+        self.fn = fn
+        self.overrun = overrun
+        self.jitter = jitter
+
+        self.ticks = deque(maxlen=history_size)
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._loop, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if wait and self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    @property
+    def running(self):
+        return self.thread.is_alive() and not self._stop.is_set()
+
+    @property
+    def last_lag(self):
+        if not self.ticks:
+            return None
+        t = self.ticks[-1]
+        return (t.started - t.scheduled).total_seconds()
+
+    @property
+    def max_lag(self):
+        if not self.ticks:
+            return None
+        return max((t.started - t.scheduled).total_seconds() for t in self.ticks)
+
+    def _loop(self):
+        scheduled = time.monotonic()
+
+        while not self._stop.is_set():
+            delay = scheduled - time.monotonic()
+            if self.jitter:
+                delay += random.uniform(0, self.jitter)
+            if delay > 0 and self._stop.wait(delay):
+                break
+
+            started = time.monotonic()
+            started_dt = datetime.now()
+            try:
+                self.fn()
+            except Exception:
+                traceback.print_exc()
+            finished = time.monotonic()
+
+            self.runs += 1
+            self.ticks.append(Tick(
+                scheduled=started_dt - timedelta(seconds=started - scheduled),
+                started=started_dt,
+                duration=finished - started,
+            ))
+
+            scheduled += self.interval
+            if finished <= scheduled:
+                continue
+
+            missed = int((finished - scheduled) // self.interval)
+            self.overruns += 1
+            print("WARNING: Run took %.1f s which is longer than interval (%s s)" %
+                  (finished - started, self.interval))
+
+            if self.overrun == OVERRUN_SKIP:
+                self.skipped += missed + 1
+                scheduled += (missed + 1) * self.interval
+            elif self.overrun == OVERRUN_DELAY:
+                scheduled = finished
+            elif self.overrun == OVERRUN_COALESCE:
+                self.skipped += missed
+                scheduled += missed * self.interval
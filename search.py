@@ -0,0 +1,94 @@
+import heapq
+import threading
+from bisect import bisect_left, insort
+
+from bot import LRUCache
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    # In-memory search over names. Queries of three characters or more are matched anywhere in the name
+    # through a trigram index, shorter ones at the start of a word through a sorted word list.
+    # Results are ranked: the whole name, then the name's start, then a word's start, then anywhere;
+    # shorter names first within each rank. Answers are memoized until the index changes.
+
+    def __init__(self, limit=20, cache_size=1000):
+        self.limit = limit
+        self.cache_size = cache_size
+
+        self.names = {}
+        # Lowercase names with single spaces, what queries are matched against
+        self._normalized = {}
+        self._trigrams = {}
+        # Sorted (word, id) pairs for prefix queries
+        self._words = []
+        self._cache = LRUCache(cache_size)
+        self._lock = threading.Lock()
+
+    def load(self, items):
+        # items are (id, name) pairs
+        with self._lock:
+            for key, name in items:
+                self._words.extend(self._add(key, name))
+            self._words.sort()
+            self._cache = LRUCache(self.cache_size)
+
+    def add(self, key, name):
+        with self._lock:
+            for word in self._add(key, name):
+                insort(self._words, word)
+            self._cache = LRUCache(self.cache_size)
+
+    def _add(self, key, name):
+        # Returns the entries for the word list
+        lower = " ".join(name.lower().split())
+        self.names[key] = name
+        self._normalized[key] = lower
+        for t in trigrams(lower):
+            self._trigrams.setdefault(t, set()).add(key)
+        return [(word, key) for word in set(lower.split())]
+
+    def search(self, query):
+        query = " ".join(query.lower().split())
+        cached = self._cache.get(query)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            if not query:
+                keys = self.names
+            elif len(query) >= 3:
+                sets = sorted((self._trigrams.get(t, set()) for t in trigrams(query)), key=len)
+                keys = set.intersection(*sets)
+            else:
+                keys = set()
+                i = bisect_left(self._words, (query,))
+                while i < len(self._words) and self._words[i][0].startswith(query):
+                    keys.add(self._words[i][1])
+                    i += 1
+
+            ranked = []
+            for key in keys:
+                name = self.names[key]
+                rank = self.rank(self._normalized[key], query)
+                if rank is not None:
+                    ranked.append((rank, len(name), name, key))
+
+            result = tuple((key, name) for _, _, name, key in heapq.nsmallest(self.limit, ranked))
+            self._cache.put(query, result)
+        return result
+
+    @staticmethod
+    def rank(name, query):
+        if name == query:
+            return 0
+        if name.startswith(query):
+            return 1
+        if (" " + query) in name:
+            return 2
+        if query in name:
+            return 3
+        return None
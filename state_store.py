@@ -0,0 +1,54 @@
+import time
+from datetime import datetime, timedelta
+
+from models import ChatState, KeyboardState
+from writer import writer
+
+
+class SqliteStateStore:
+    # Keeps the bot's chat states and inline keyboards in the database, so they survive restarts and
+    # chats evicted from memory can be loaded again. Keyboards sent more than keyboard_days ago and chats
+    # idle for chat_days are deleted: their buttons stop working and the chat starts over.
+
+    def __init__(self, chat_days=None, keyboard_days=30, expire_every=3600):
+        self.chat_days = chat_days
+        self.keyboard_days = keyboard_days
+        self.expire_every = expire_every
+        self._next_expire = 0
+
+    def load_chat(self, chat_id):
+        row = ChatState.get_or_none(ChatState.chat_id == chat_id)
+        return row.data if row is not None else None
+
+    def save_chat(self, chat_id, data):
+        writer.run(ChatState
+                   .insert(chat_id=chat_id, data=data, updated=datetime.now())
+                   .on_conflict(conflict_target=[ChatState.chat_id],
+                                preserve=[ChatState.data, ChatState.updated])
+                   .execute)
+        self._maybe_expire()
+
+    def load_keyboard(self, chat_id, message_id):
+        row = KeyboardState.get_or_none((KeyboardState.chat_id == chat_id) &
+                                        (KeyboardState.message_id == message_id))
+        return row.data if row is not None else None
+
+    def save_keyboard(self, chat_id, message_id, data):
+        writer.run(KeyboardState
+                   .insert(chat_id=chat_id, message_id=message_id, data=data, updated=datetime.now())
+                   .on_conflict(conflict_target=[KeyboardState.chat_id, KeyboardState.message_id],
+                                preserve=[KeyboardState.data, KeyboardState.updated])
+                   .execute)
+        self._maybe_expire()
+
+    def _maybe_expire(self):
+        if time.monotonic() >= self._next_expire:
+            self._next_expire = time.monotonic() + self.expire_every
+            writer.run(self.expire)
+
+    def expire(self, now=None):
+        now = now or datetime.now()
+        if self.chat_days is not None:
+            ChatState.delete().where(ChatState.updated < now - timedelta(days=self.chat_days)).execute()
+        if self.keyboard_days is not None:
+            KeyboardState.delete().where(KeyboardState.updated < now - timedelta(days=self.keyboard_days)).execute()
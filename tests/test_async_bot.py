@@ -0,0 +1,196 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import parse_qsl
+
+import pytest
+from aiohttp import web
+from telebot import asyncio_helper
+
+from async_bot import AsyncTelegramBot
+from bot import BotState
+
+TOKEN = "123:test"
+
+
+class FakeBotApi:
+    # Local Bot API server answering getUpdates, sendMessage, setWebhook and deleteWebhook.
+    # Requests are kept in `requests` as (method, params), sent messages in `sent` as (chat_id, text).
+
+    def __init__(self):
+        self.updates = []
+        self.requests = []
+        self.sent = []
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        self.url = "http://127.0.0.1:%d" % self.runner.addresses[0][1]
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+
+    async def _handle(self, request):
+        # telebot sends the parameters as a form, GET requests included
+        params = dict(request.query)
+        params.update(parse_qsl((await request.read()).decode()))
+        method = request.match_info["method"]
+        self.requests.append((method, params))
+
+        if method == "getUpdates":
+            offset = int(params.get("offset", 0))
+            # A short long poll
+            for _ in range(10):
+                updates = [u for u in self.updates if u["update_id"] >= offset]
+                if updates:
+                    break
+                await asyncio.sleep(0.05)
+            return self._result(updates)
+        if method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            self.sent.append((chat_id, params["text"]))
+            return self._result({"message_id": len(self.sent), "date": 0,
+                                 "chat": {"id": chat_id, "type": "private"}, "text": params["text"]})
+        return self._result(True)
+
+    @staticmethod
+    def _result(result):
+        return web.json_response({"ok": True, "result": result})
+
+    def add_message(self, chat_id, text):
+        self.updates.append(message_update(len(self.updates) + 1, chat_id, text))
+
+    def count(self, method):
+        return sum(1 for m, _ in self.requests if m == method)
+
+    def texts(self, chat_id):
+        return [text for c, text in self.sent if c == chat_id]
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class EchoState(BotState):
+    def default(self, text):
+        if text.startswith("slow"):
+            time.sleep(0.2)
+        self.chat.reply("echo " + text)
+
+
+def message_update(update_id, chat_id, text):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": 0, "text": text,
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+    }}
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def api():
+    api_url = asyncio_helper.API_URL
+    api = FakeBotApi()
+    yield api
+    api.close()
+    asyncio_helper.API_URL = api_url
+
+
+def make_bot(api, **kwargs):
+    bot = AsyncTelegramBot(TOKEN, EchoState, api_url=api.url, polling_timeout=1, **kwargs)
+    bot.allow_chat(1)
+    bot.allow_chat(2)
+    return bot
+
+
+def test_polling_delivers_updates_of_each_chat_in_order(api):
+    bot = make_bot(api)
+    for text in ["slow 1", "2", "3", "slow 4", "5"]:
+        api.add_message(1, text)
+    for text in ["a", "b", "c"]:
+        api.add_message(2, text)
+
+    bot.start()
+    try:
+        wait_for(lambda: len(api.sent) == 8)
+        assert api.texts(1) == ["echo slow 1", "echo 2", "echo 3", "echo slow 4", "echo 5"]
+        assert api.texts(2) == ["echo a", "echo b", "echo c"]
+        assert api.count("deleteWebhook") == 1
+
+        api.add_message(2, "d")
+        wait_for(lambda: len(api.sent) == 9)
+        assert api.texts(2)[-1] == "echo d"
+    finally:
+        bot.stop()
+
+    # Each update is handled once
+    assert len(api.sent) == 9
+
+
+def test_stop_shuts_down_polling_and_the_event_loop(api):
+    bot = make_bot(api)
+    bot.start()
+    wait_for(lambda: api.count("getUpdates") >= 1)
+    bot.stop()
+
+    assert not bot.loop_thread.is_alive()
+    assert bot.loop.is_closed()
+    polls = api.count("getUpdates")
+    time.sleep(0.3)
+    assert api.count("getUpdates") == polls
+
+
+def post_update(url, update, secret=None):
+    headers = {"Content-Type": "application/json"}
+    if secret is not None:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = secret
+    request = urllib.request.Request(url, json.dumps(update).encode(), headers)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_webhook_rejects_a_wrong_secret_token(api):
+    port = free_port()
+    url = "http://127.0.0.1:%d/hook" % port
+    bot = make_bot(api, webhook_url=url, webhook_listen="127.0.0.1", webhook_port=port, webhook_secret="s3cret")
+    bot.start()
+    try:
+        assert ("setWebhook", {"url": url, "secret_token": "s3cret"}) in api.requests
+
+        assert post_update(url, message_update(1, 1, "wrong"), secret="guess") == 403
+        assert post_update(url, message_update(2, 1, "missing")) == 403
+        assert post_update(url, message_update(3, 1, "right"), secret="s3cret") == 200
+        wait_for(lambda: len(api.sent) == 1)
+        assert api.sent == [(1, "echo right")]
+        assert api.count("getUpdates") == 0
+    finally:
+        bot.stop()
+
+    with pytest.raises(urllib.error.URLError):
+        post_update(url, message_update(4, 1, "stopped"), secret="s3cret")
@@ -0,0 +1,49 @@
+import threading
+import time
+
+from bot import ChatDispatcher
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_chat_is_told_of_updates_dropped_while_its_handler_is_stuck():
+    drops = []
+    handled = []
+    gate = threading.Event()
+    dispatcher = ChatDispatcher(workers=2, max_pending=10, timeout=0.2,
+                                on_drop=lambda chat_id, count: drops.append((chat_id, count)))
+    try:
+        dispatcher.submit(1, lambda: gate.wait())
+        dispatcher.submit(1, handled.append, "queued")
+        wait_for(lambda: drops == [(1, 1)])
+        dispatcher.submit(1, handled.append, "new")
+        wait_for(lambda: drops == [(1, 1), (1, 1)])
+
+        # Other chats aren't affected
+        dispatcher.submit(2, handled.append, "other")
+        wait_for(lambda: handled == ["other"])
+    finally:
+        gate.set()
+        dispatcher.stop()
+
+    assert dispatcher.dropped == 2
+    assert handled == ["other"]
+
+
+def test_stop_handles_the_queued_updates():
+    handled = []
+    gate = threading.Event()
+    dispatcher = ChatDispatcher(workers=2, max_pending=10, timeout=5)
+    dispatcher.submit(1, lambda: gate.wait())
+    for i in range(3):
+        dispatcher.submit(1, handled.append, i)
+    threading.Timer(0.1, gate.set).start()
+    dispatcher.stop()
+
+    assert handled == [0, 1, 2]
+    assert dispatcher.pending() == 0
@@ -0,0 +1,44 @@
+import os
+
+from arping_scanner import PassiveMonitor
+
+# passive.pcap, times in seconds since the epoch:
+#   1000  ARP reply from 10.0.0.5 (aa:00:00:00:00:05)
+#   1001  ARP probe from 0.0.0.0 (aa:00:00:00:00:06)
+#   1002  UDP from 192.168.1.7, routed (aa:00:00:00:00:07)
+#   1003  ARP request from 10.1.0.8, another subnet (aa:00:00:00:00:08)
+#   1010  UDP from 10.0.0.9 (AA:00:00:00:00:09)
+#   1012  IPv6 neighbor solicitation (aa:00:00:00:00:0a)
+PCAP = os.path.join(os.path.dirname(__file__), "data", "passive.pcap")
+
+
+def replay(ttl):
+    monitor = PassiveMonitor("lo", "10.0.0.0/24", ttl)
+    monitor.replay(PCAP)
+    return monitor
+
+
+def test_only_hosts_of_the_subnet_are_recorded():
+    monitor = replay(ttl=30)
+
+    assert sorted(monitor.hosts(now=1020)) == [
+        ("aa:00:00:00:00:05", "10.0.0.5"),
+        ("aa:00:00:00:00:09", "10.0.0.9"),
+    ]
+    assert monitor.last_seen["aa:00:00:00:00:05"] == ("10.0.0.5", 1000)
+
+
+def test_hosts_expire_after_ttl():
+    monitor = replay(ttl=30)
+
+    assert monitor.hosts(now=1035) == [("aa:00:00:00:00:09", "10.0.0.9")]
+    assert "aa:00:00:00:00:05" not in monitor.last_seen
+    assert monitor.hosts(now=1041) == []
+    assert monitor.last_seen == {}
+
+
+def test_older_packets_dont_overwrite_newer_ones():
+    monitor = replay(ttl=30)
+    monitor.update([("aa:00:00:00:00:09", "10.0.0.99")], 1005)
+
+    assert monitor.last_seen["aa:00:00:00:00:09"] == ("10.0.0.9", 1010)
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+from main import fetch_report_page, show_report
+from migrations import migrate
+from models import db, DeviceLastSeen
+from partitions import partitions
+
+NOW = datetime(2024, 5, 1, 12, 0)
+SIZE = 10
+
+
+@pytest.fixture
+def devices(tmp_path):
+    db.init(str(tmp_path / "lan.db"))
+    partitions.reload()
+    migrate()
+    # 40 devices, one seen per minute: mac 00 just now, mac 39 39 minutes ago
+    DeviceLastSeen.insert_many([
+        {"mac_addr": mac(i), "ip_addr": "10.0.0.%d" % i, "last_seen": NOW - timedelta(minutes=i)}
+        for i in range(40)
+    ]).execute()
+    yield
+    db.close()
+
+
+def mac(i):
+    return "02:00:00:00:00:%02d" % i
+
+
+def macs(rows):
+    return [r.mac_addr for r in rows]
+
+
+def key(row):
+    return [row.last_seen.isoformat(), row.mac_addr]
+
+
+def scan(indexes, timestamp):
+    DeviceLastSeen.update(last_seen=timestamp).where(DeviceLastSeen.mac_addr.in_([mac(i) for i in indexes])).execute()
+
+
+def test_paging_forward_and_backward(devices):
+    since = NOW - timedelta(hours=1)
+    pages = []
+    cursor = None
+    while True:
+        rows, more = fetch_report_page(since, cursor, size=SIZE)
+        pages.append(rows)
+        if not more:
+            break
+        cursor = key(rows[-1])
+
+    assert [macs(p) for p in pages] == [[mac(i) for i in range(n, n + SIZE)] for n in range(0, 40, SIZE)]
+
+    rows, more = fetch_report_page(since, key(pages[2][0]), backward=True, size=SIZE)
+    assert macs(rows) == macs(pages[1])
+    assert more
+    rows, more = fetch_report_page(since, key(pages[1][0]), backward=True, size=SIZE)
+    assert macs(rows) == macs(pages[0])
+    assert not more
+
+
+def test_period_limits_the_rows(devices):
+    rows, more = fetch_report_page(NOW - timedelta(minutes=15), size=SIZE)
+    rows2, more2 = fetch_report_page(NOW - timedelta(minutes=15), key(rows[-1]), size=SIZE)
+
+    assert macs(rows + rows2) == [mac(i) for i in range(15)]
+    assert more and not more2
+
+
+def test_devices_seen_again_between_clicks_move_to_the_first_page(devices):
+    since = NOW - timedelta(hours=1)
+    page1, _ = fetch_report_page(since, size=SIZE)
+    page2, _ = fetch_report_page(since, key(page1[-1]), size=SIZE)
+
+    # A scan sees again devices of the first two pages
+    later = NOW + timedelta(minutes=1)
+    scan([3, 12, 15], later)
+    since = later - timedelta(hours=1)
+
+    # Newer than the second page are now the devices seen again too, at the top
+    rows, more = fetch_report_page(since, key(page2[0]), backward=True, size=SIZE)
+    assert macs(rows) == [mac(i) for i in [3, 0, 1, 2, 4, 5, 6, 7, 8, 9]]
+    assert more
+    first, _ = fetch_report_page(since, size=SIZE)
+    assert macs(first) == [mac(i) for i in [15, 12, 3, 0, 1, 2, 4, 5, 6, 7]]
+
+    # Going on from the second page skips the devices that moved up, nothing vanishes
+    page3, _ = fetch_report_page(since, key(page2[-1]), size=SIZE)
+    assert macs(page3) == [mac(i) for i in range(20, 30)]
+
+    seen = set()
+    cursor = None
+    while True:
+        rows, more = fetch_report_page(since, cursor, size=SIZE)
+        seen.update(macs(rows))
+        if not more:
+            break
+        cursor = key(rows[-1])
+    assert seen == {mac(i) for i in range(40)}
+
+
+class FakeChat:
+    def __init__(self):
+        self.shown = []
+
+    def inline(self, text, markup=None, setup=None, **kwargs):
+        self.shown.append((text, setup))
+
+    def edit(self, message_id, text, markup=None, setup=None, **kwargs):
+        self.shown.append((text, setup))
+
+
+def test_newer_after_a_scan_shows_a_full_first_page(devices, monkeypatch):
+    monkeypatch.setattr(main, "REPORT_PAGE_SIZE", SIZE)
+    monkeypatch.setattr(main.fetch_report_page, "__defaults__", (None, False, SIZE))
+    chat = FakeChat()
+
+    show_report(chat, "last1h", NOW)
+    _, first = chat.shown[-1]
+    show_report(chat, "last1h", NOW, 2, first["last"], message_id=1)
+    text, second = chat.shown[-1]
+    assert second["page_no"] == 2 and second["has_newer"] and second["has_older"]
+
+    later = NOW + timedelta(minutes=1)
+    scan(range(0, 35), later)
+
+    # "Newer" from the second page: the devices seen again are there, not gone
+    show_report(chat, "last1h", later, 1, second["first"], backward=True, message_id=1)
+    text, page = chat.shown[-1]
+    assert page["page_no"] == 1 and not page["has_newer"] and page["has_older"]
+    assert text.count("<code>") == SIZE
+    assert "No devices" not in text
@@ -0,0 +1,213 @@
+import socket
+import threading
+import time
+
+from routeros_api.base_api import encode_length, decode_length
+
+from routeros_scanner import RouterOsScanner, ArpTableMirror, Backoff
+
+
+class FakeRouterOs:
+    # Speaks enough of the RouterOS API for the scanner: plaintext login, /ip/arp/print with
+    # .proplist and equality queries, and /ip/arp/listen. Received commands are kept in `requests`.
+
+    def __init__(self, table):
+        self.table = {row[".id"]: dict(row) for row in table}
+        self.requests = []
+        self.connections = []
+        # (connection, tag) of the listen commands
+        self.listeners = []
+        self._lock = threading.Lock()
+
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with self._lock:
+                self.connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        def read(n):
+            data = b""
+            while len(data) < n:
+                chunk = conn.recv(n - len(data))
+                if not chunk:
+                    raise EOFError
+                data += chunk
+            return data
+
+        try:
+            while True:
+                words = []
+                while True:
+                    word = read(decode_length(read)).decode()
+                    if not word:
+                        break
+                    words.append(word)
+                self._handle(conn, words)
+        except (EOFError, OSError):
+            pass
+
+    def _handle(self, conn, words):
+        command = words[0]
+        tag = next(w[len(".tag="):] for w in words if w.startswith(".tag="))
+        if command == "/login":
+            self._send(conn, ["!done", ".tag=" + tag])
+            return
+
+        with self._lock:
+            self.requests.append(words)
+        if command == "/ip/arp/print":
+            args = dict(w[1:].split("=", 1) for w in words if w.startswith("="))
+            queries = dict(w[1:].split("=", 1) for w in words if w.startswith("?"))
+            fields = args[".proplist"].split(",") if ".proplist" in args else None
+            for row in list(self.table.values()):
+                if all(row.get(k) == v for k, v in queries.items()):
+                    self._send_row(conn, tag, {k: v for k, v in row.items() if fields is None or k in fields})
+            self._send(conn, ["!done", ".tag=" + tag])
+        elif command == "/ip/arp/listen":
+            with self._lock:
+                self.listeners.append((conn, tag))
+
+    def _send(self, conn, words):
+        with self._lock:
+            conn.sendall(b"".join(encode_length(len(w)) + w for w in [w.encode() for w in words + [""]]))
+
+    def _send_row(self, conn, tag, row):
+        self._send(conn, ["!re"] + ["=%s=%s" % item for item in row.items()] + [".tag=" + tag])
+
+    def _notify(self, row):
+        with self._lock:
+            listeners = list(self.listeners)
+        for conn, tag in listeners:
+            try:
+                self._send_row(conn, tag, row)
+            except OSError:
+                pass
+
+    def set(self, row):
+        self.table.setdefault(row[".id"], {}).update(row)
+        self._notify(self.table[row[".id"]])
+
+    def remove(self, id):
+        del self.table[id]
+        self._notify({".id": id, ".dead": "true"})
+
+    def disconnect_all(self):
+        with self._lock:
+            connections, self.connections, self.listeners = self.connections, [], []
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Closed by the client already
+                pass
+            conn.close()
+
+    def listen_count(self):
+        with self._lock:
+            return sum(1 for words in self.requests if words[0] == "/ip/arp/listen")
+
+    def close(self):
+        self.server.close()
+        self.disconnect_all()
+
+
+def arp_row(id, mac_addr, ip_addr, complete="true"):
+    return {".id": id, "address": ip_addr, "mac-address": mac_addr, "interface": "bridge",
+            "complete": complete, "dynamic": "true", "comment": ""}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def make_router():
+    return FakeRouterOs([
+        arp_row("*1", "AA:00:00:00:00:01", "10.0.0.1"),
+        arp_row("*2", "AA:00:00:00:00:02", "10.0.0.2"),
+        arp_row("*3", "AA:00:00:00:00:03", "10.0.0.3", complete="false"),
+    ])
+
+
+def make_scanner(router):
+    return RouterOsScanner(60, "127.0.0.1", "admin", "", port=router.port, use_ssl=False)
+
+
+def test_fetch_hosts_requests_only_needed_fields_of_complete_entries():
+    router = make_router()
+    scanner = make_scanner(router)
+    try:
+        hosts = scanner.fetch_hosts()
+    finally:
+        scanner.connection.disconnect()
+        router.close()
+
+    assert sorted(hosts) == [
+        ("AA:00:00:00:00:01", "10.0.0.1", "bridge"),
+        ("AA:00:00:00:00:02", "10.0.0.2", "bridge"),
+    ]
+    request = router.requests[-1]
+    assert request[0] == "/ip/arp/print"
+    assert "=.proplist=address,mac-address,interface" in request
+    assert "?complete=true" in request
+
+
+def test_mirror_applies_changes_and_resyncs_after_reconnect():
+    router = make_router()
+    mirror = ArpTableMirror(make_scanner(router).create_pool, Backoff(base=0.05, cap=0.05))
+    mirror.start()
+    try:
+        wait_for(lambda: mirror.synced)
+        assert sorted(mirror.hosts()) == [
+            ("AA:00:00:00:00:01", "10.0.0.1", "bridge"),
+            ("AA:00:00:00:00:02", "10.0.0.2", "bridge"),
+        ]
+
+        router.set(arp_row("*4", "AA:00:00:00:00:04", "10.0.0.4"))
+        wait_for(lambda: ("AA:00:00:00:00:04", "10.0.0.4", "bridge") in mirror.hosts())
+        router.set({".id": "*3", "complete": "true"})
+        wait_for(lambda: ("AA:00:00:00:00:03", "10.0.0.3", "bridge") in mirror.hosts())
+        router.remove("*1")
+        wait_for(lambda: len(mirror.hosts()) == 3)
+        assert "*1" not in mirror.entries
+
+        # Changes made while disconnected are only found by fetching the table again
+        router.disconnect_all()
+        router.table.pop("*2")
+        wait_for(lambda: router.listen_count() == 2 and mirror.synced)
+        assert sorted(mirror.hosts()) == [
+            ("AA:00:00:00:00:03", "10.0.0.3", "bridge"),
+            ("AA:00:00:00:00:04", "10.0.0.4", "bridge"),
+        ]
+    finally:
+        mirror.stop()
+        router.close()
+
+
+def test_mirror_listens_again_after_max_changes():
+    router = make_router()
+    mirror = ArpTableMirror(make_scanner(router).create_pool, Backoff(base=0.05, cap=0.05), max_changes=2)
+    mirror.start()
+    try:
+        wait_for(lambda: mirror.synced)
+        for i in range(5, 10):
+            router.set(arp_row("*%d" % i, "AA:00:00:00:00:%02d" % i, "10.0.0.%d" % i))
+            wait_for(lambda: "*%d" % i in mirror.entries)
+
+        # Each listen has been issued again after its second change
+        wait_for(lambda: router.listen_count() >= 3 and mirror.resyncs >= 2 and mirror.synced)
+        assert len(mirror.hosts()) == 7
+    finally:
+        mirror.stop()
+        router.close()
@@ -0,0 +1,122 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from models import db
+
+_STOP = object()
+
+
+class DatabaseWriter:
+    # All writes go through one thread, so scanners, the retention job and the bot never wait
+    # for each other's write locks. Jobs queued while a transaction runs are committed together
+    # in the next one, each in its own savepoint so that a failing job doesn't roll back the others.
+    # The queue is bounded: when it is full, writers block until the thread catches up.
+
+    def __init__(self, database, max_queue=1000, max_batch=100, history_size=100):
+        self.db = database
+        self.queue = queue.Queue(max_queue)
+        self.max_batch = max_batch
+
+        self.commits = 0
+        self.jobs = 0
+        self.errors = 0
+        self.max_depth = 0
+        # Duration of the last transactions, from the first job to the commit
+        self.latencies = deque(maxlen=history_size)
+
+        self.thread = threading.Thread(target=self._loop, name="db-writer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join()
+
+    @property
+    def running(self):
+        return self.thread.is_alive()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.queue.put((fn, args, future))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return future
+
+    def run(self, fn, *args):
+        # Runs fn in a transaction and returns its result. Before the thread is started (migrations,
+        # scripts) and for jobs that write from the writer thread itself, fn is run in place.
+        if not self.running or threading.current_thread() is self.thread:
+            with self.db.atomic():
+                return fn(*args)
+        return self.submit(fn, *args).result()
+
+    def _loop(self):
+        while True:
+            jobs = [self.queue.get()]
+            while len(jobs) < self.max_batch:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = _STOP in jobs
+            jobs = [j for j in jobs if j is not _STOP]
+            if jobs:
+                self._commit(jobs)
+            if stop:
+                return
+
+    def _commit(self, jobs):
+        start = time.monotonic()
+        results = []
+        try:
+            with self.db.atomic():
+                for fn, args, future in jobs:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with self.db.atomic():
+                            results.append((future, fn(*args), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            print("Database commit failed: %r" % e)
+            self.errors += len(jobs)
+            for _, _, future in jobs:
+                if future.running():
+                    future.set_exception(e)
+            return
+
+        self.latencies.append(time.monotonic() - start)
+        self.commits += 1
+        self.jobs += len(jobs)
+
+        # Callers are notified only after the commit, so they never see uncommitted writes
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                self.errors += 1
+                future.set_exception(error)
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_depth,
+            "commits": self.commits,
+            "jobs": self.jobs,
+            "errors": self.errors,
+            "jobs_per_commit": self.jobs / self.commits if self.commits else None,
+            "last_commit_latency": latencies[-1] if latencies else None,
+            "avg_commit_latency": sum(latencies) / len(latencies) if latencies else None,
+            "max_commit_latency": max(latencies) if latencies else None,
+        }
+
+
+writer = DatabaseWriter(db)